@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+
+# Benchmarks for LZSS decoding/encoding, WIP loading, ARC pack/unpack and WSC conversion on synthetic fixtures.
+
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import tempfile
+import time
+
+import wipf
+import will_arc
+import wsc2scr
+
+
+def make_lzss_stream(size, compressible, rnd):
+    # Produce a valid stream decoding to exactly `size` bytes.
+    # Compressible streams are mostly long look-backs over recent output, random ones mostly literals.
+    literal_ratio = 0.2 if compressible else 0.9
+    out = bytearray()
+    produced = 0
+    while produced < size:
+        flags = 0
+        items = bytearray()
+        for bit in range(8):
+            remaining = size - produced
+            if remaining == 0:
+                break
+            if produced < 32 or remaining < 2 or rnd.random() < literal_ratio:
+                flags |= 1 << bit
+                items.append(rnd.randrange(256))
+                produced += 1
+            else:
+                length = rnd.choice((17, 17, 14, 10, 4)) if compressible else rnd.randrange(2, 18)
+                length = min(length, remaining)
+                distance = rnd.choice((1, 3, 4, 640)) if compressible else rnd.randrange(1, min(produced, 4095) + 1)
+                look_back_index = (produced + 1 - distance) & 0xfff
+                # Index 0 with length 2 would be read as end-of-stream
+                if look_back_index == 0 and length == 2:
+                    flags |= 1 << bit
+                    items.append(0)
+                    produced += 1
+                    continue
+                items += ((look_back_index << 4) | (length - 2)).to_bytes(2, 'big')
+                produced += length
+        out.append(flags)
+        out += items
+    # End-of-stream marker in its own flag group
+    out.append(0)
+    out += b'\x00\x00'
+    return bytes(out)
+
+def make_cg_image(width, height, rnd):
+    # BGR gradient with a little noise, roughly how LZSS sees a photo-like CG (compresses to about 90%)
+    noise = rnd.randbytes(width * height * 3)
+    out = bytearray(width * height * 3)
+    i = 0
+    for y in range(height):
+        for x in range(width):
+            out[i] = min(255, x * 255 // width + noise[i] % 3)
+            out[i+1] = min(255, y * 255 // height + noise[i+1] % 3)
+            out[i+2] = min(255, (x + y) * 255 // (width + height) + noise[i+2] % 3)
+            i += 3
+    return bytes(out)
+
+def make_wip(depth, objects, width, height, compressible, rnd):
+    header = wipf.WIPFHeader()
+    header.magic = wipf.WIPF_MAGIC
+    header.objects = objects
+    header.depth = depth
+    object_headers = []
+    body = io.BytesIO()
+    for _ in range(objects):
+        stream = make_lzss_stream(width * height * depth // 8, compressible, rnd)
+        objhdr = wipf.WIPFObjectHeader()
+        objhdr.dimension.x, objhdr.dimension.y = width, height
+        objhdr.size = len(stream)
+        object_headers.append(objhdr)
+        if depth == 8:
+            body.write(rnd.randbytes(256 * 4))
+        body.write(stream)
+    out = io.BytesIO()
+    out.write(header)
+    for objhdr in object_headers:
+        out.write(objhdr)
+    out.write(body.getvalue())
+    return out.getvalue()
+
+def make_arc_dir(path, count, size, rnd):
+    os.makedirs(path, exist_ok=True)
+    total = 0
+    for i in range(count):
+        with open(os.path.join(path, f'V{i:07d}.OGG'), 'wb') as f:
+            data = rnd.randbytes(rnd.randrange(size // 2, size * 3 // 2))
+            f.write(data)
+            total += len(data)
+    return total
+
+def measure(fn, repeat):
+    fn()
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def report(results, name, elapsed, nbytes=None, objects=None):
+    entry = {'seconds': elapsed}
+    line = f'{name:<40} {elapsed * 1000:10.2f} ms'
+    if nbytes is not None:
+        entry['mb_per_s'] = nbytes / elapsed / 1e6
+        line += f' {entry["mb_per_s"]:10.2f} MB/s'
+    if objects is not None:
+        entry['objects_per_s'] = objects / elapsed
+        line += f' {entry["objects_per_s"]:12.1f} obj/s'
+    results[name] = entry
+    print(line)
+
+def baseline_lzss_decompress(compressed, size=None):
+    # wipf.py's original pure-Python decoder, the reference for LZSS_CG_TARGET
+    compressed_io = io.BytesIO(compressed)
+    decompressed = io.BytesIO()
+    window = bytearray(4096)
+    index = 1
+    flags_buf = bytearray(1)
+    eos = False
+    while not eos:
+        if compressed_io.readinto(flags_buf) != 1:
+            raise EOFError('Unexpected end-of-stream when decompressing data.')
+        flags = flags_buf[0]
+        for _ in range(8):
+            if flags & 1:
+                byte = compressed_io.read(1)
+                if len(byte) != 1:
+                    raise EOFError('Unexpected end-of-stream when decompressing data.')
+                decompressed.write(byte)
+                window[index] = byte[0]
+                index = (index + 1) % len(window)
+            else:
+                inst = compressed_io.read(2)
+                if len(inst) != 2:
+                    raise EOFError('Unexpected end-of-stream when decompressing data.')
+                inst = int.from_bytes(inst, 'big')
+                look_back_index, look_back_len = ((inst >> 4) & 0xfff), ((inst & 0xf) + 2)
+                if look_back_index == 0 and look_back_len == 2:
+                    eos = True
+                    break
+                for _ in range(look_back_len):
+                    byte = window[look_back_index]
+                    decompressed.write(byte.to_bytes(1, 'big'))
+                    window[index] = byte
+                    index = (index + 1) % len(window)
+                    look_back_index = (look_back_index + 1) % len(window)
+            flags >>= 1
+    return decompressed.getvalue()
+
+# Wanted speedup of the pure-Python decoder over baseline_lzss_decompress on a CG-like image. Not met yet (about 3x).
+LZSS_CG_TARGET = 10
+
+def lzss_decoders():
+    decoders = [('py', wipf.wip_lzss_decompress_py)]
+    if wipf.numba is not None:
+        decoders.append(('numba', wipf.wip_lzss_decompress_numba))
+    if wipf.lzss_library is not None:
+        decoders.append(('native', wipf.wip_lzss_decompress_native))
+    return decoders
+
+def bench_lzss(results, scale, repeat, rnd):
+    for kind, compressible in (('random', False), ('compressible', True)):
+        stream = make_lzss_stream(int(4e6 * scale), compressible, rnd)
+        size = len(wipf.wip_lzss_decompress(stream))
+        for name, decoder in lzss_decoders():
+            elapsed = measure(lambda: decoder(stream, size), repeat)
+            report(results, f'lzss/{kind}/{name}', elapsed, size)
+
+def bench_lzss_cg(results, scale, repeat, rnd):
+    height = max(1, int(360 * scale))
+    data = make_cg_image(640, height, rnd)
+    stream = bytes(wipf.wip_lzss_compress(data))
+    baseline = measure(lambda: baseline_lzss_decompress(stream, len(data)), repeat)
+    report(results, 'lzss/cg/baseline', baseline, len(data))
+    for name, decoder in lzss_decoders():
+        elapsed = measure(lambda: decoder(stream, len(data)), repeat)
+        report(results, f'lzss/cg/{name}', elapsed, len(data))
+        speedup = results[f'lzss/cg/{name}']['speedup'] = baseline / elapsed
+        line = f'{"":<40} {speedup:10.2f}x baseline'
+        if name == 'py':
+            line += f' (target {LZSS_CG_TARGET}x, {"met" if speedup >= LZSS_CG_TARGET else "missed"})'
+        print(line)
+
+def bench_lzss_encode(results, scale, repeat, rnd):
+    encoders = [('py', wipf.wip_lzss_compress_py)]
+    if wipf.numba is not None:
+        encoders.append(('numba', wipf.wip_lzss_compress_numba))
+    for kind, compressible in (('random', False), ('compressible', True)):
+        data = bytes(wipf.wip_lzss_decompress(make_lzss_stream(int(1e6 * scale), compressible, rnd)))
+        for name, encoder in encoders:
+            elapsed = measure(lambda: encoder(data), repeat)
+            report(results, f'lzss_encode/{kind}/{name}', elapsed, len(data))
+
+def bench_load_wipf(results, scale, repeat, rnd):
+    for depth in (8, 24):
+        for objects in (1, 4):
+            height = max(1, int(480 * scale))
+            data = make_wip(depth, objects, 640, height, True, rnd)
+            nbytes = 640 * height * depth // 8 * objects
+            elapsed = measure(lambda: wipf.load_wipf(io.BytesIO(data), verbose=False), repeat)
+            report(results, f'load_wipf/{depth}bit/{objects}obj', elapsed, nbytes, objects)
+
+def bench_arc(results, scale, repeat, rnd, work_dir):
+    count = max(1, int(5000 * scale))
+    src = os.path.join(work_dir, 'arc_src')
+    total = make_arc_dir(src, count, 8192, rnd)
+    for version in (1, 2):
+        arc_path = os.path.join(work_dir, f'v{version}.arc')
+        elapsed = measure(lambda: will_arc.pack(src, arc_path, version), repeat)
+        report(results, f'arc/pack/v{version}', elapsed, total, count)
+        out = os.path.join(work_dir, f'v{version}_out')
+        elapsed = measure(lambda: will_arc.unpack(arc_path, out, version), repeat)
+        report(results, f'arc/unpack/v{version}', elapsed, total, count)
+
+def bench_wsc(results, scale, repeat, rnd, work_dir):
+    data = rnd.randbytes(int(64e6 * scale))
+    elapsed = measure(lambda: wsc2scr.deobfuscate(data), repeat)
+    report(results, 'wsc/deobfuscate', elapsed, len(data))
+    wsc_path = os.path.join(work_dir, 'bench.WSC')
+    with open(wsc_path, 'wb') as f:
+        f.write(data)
+    scr_path = os.path.join(work_dir, 'bench.SCR')
+    elapsed = measure(lambda: wsc2scr.convert_file(wsc_path, scr_path), repeat)
+    report(results, 'wsc/convert_file', elapsed, len(data))
+
+BENCHMARKS = {
+    'lzss': bench_lzss,
+    'lzss_cg': bench_lzss_cg,
+    'lzss_encode': bench_lzss_encode,
+    'load_wipf': bench_load_wipf,
+    'arc': bench_arc,
+    'wsc': bench_wsc,
+}
+
+def compare(results, previous):
+    print()
+    print(f'{"Comparison":<40} {"previous":>10} {"current":>10} {"speedup":>9}')
+    for name, entry in results.items():
+        old = previous.get(name)
+        if old is None:
+            continue
+        print(f'{name:<40} {old["seconds"] * 1000:8.2f}ms {entry["seconds"] * 1000:8.2f}ms {old["seconds"] / entry["seconds"]:8.2f}x')
+
+def parse_args():
+    p = argparse.ArgumentParser()
+    p.add_argument('benchmark', nargs='*', help=f'Benchmarks to run (defaults to all of {", ".join(BENCHMARKS)}).')
+    p.add_argument('-s', '--scale', type=float, default=1.0, help='Scale fixture sizes (defaults to 1.0).')
+    p.add_argument('-r', '--repeat', type=int, default=3, help='Number of timed runs. The best one is reported (defaults to 3).')
+    p.add_argument('--seed', type=int, default=0, help='Seed for fixture generation (defaults to 0).')
+    p.add_argument('-o', '--save', help='Save results to this JSON file.')
+    p.add_argument('-c', '--compare', help='Compare with results saved by a previous run.')
+    args = p.parse_args()
+    for name in args.benchmark:
+        if name not in BENCHMARKS:
+            p.error(f'Unknown benchmark {name}.')
+    return p, args
+
+if __name__ == '__main__':
+    p, args = parse_args()
+    results = {}
+    with tempfile.TemporaryDirectory() as work_dir:
+        for name in args.benchmark or BENCHMARKS:
+            # Same fixtures for the same seed regardless of which benchmarks are selected
+            rnd = random.Random(f'{args.seed}/{name}')
+            fn = BENCHMARKS[name]
+            if fn in (bench_arc, bench_wsc):
+                fn(results, args.scale, args.repeat, rnd, work_dir)
+            else:
+                fn(results, args.scale, args.repeat, rnd)
+    if args.compare is not None:
+        with open(args.compare, 'r') as f:
+            compare(results, json.load(f)['results'])
+    if args.save is not None:
+        with open(args.save, 'w') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'numba': wipf.numba is not None,
+                'native': wipf.lzss_library is not None,
+                'scale': args.scale,
+                'seed': args.seed,
+                'results': results,
+            }, f, indent=4)
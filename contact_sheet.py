@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+
+# Tile thumbnails of WIP images into contact sheets for quick browsing.
+
+import argparse
+import contextlib
+import os
+
+from concurrent import futures
+from PIL import Image, ImageDraw, ImageFont
+
+import wipf
+
+
+LABEL_LINE_HEIGHT = 12
+LABEL_LINES = 2
+PADDING = 4
+BACKGROUND = (64, 64, 64)
+
+
+def parse_args():
+    p = argparse.ArgumentParser()
+    p.add_argument('input', nargs='+', help='WIP files, directories, ARC archives or globs.')
+    p.add_argument('-o', '--output', default='sheet_{page}.png', help='Output file ({page} is replaced with the page number, defaults to sheet_{page}.png).')
+    p.add_argument('-s', '--size', type=int, default=160, help='Maximum thumbnail width/height (defaults to 160).')
+    p.add_argument('-c', '--columns', type=int, default=8, help='Thumbnails per row (defaults to 8).')
+    p.add_argument('-r', '--rows', type=int, default=6, help='Rows per page (defaults to 6).')
+    p.add_argument('-n', '--no-mask', action='store_true', help='Do not look for mask files.')
+    p.add_argument('-f', '--flatten', action='store_true', help='Draw all objects of an image onto one thumbnail.')
+    p.add_argument('-j', '--jobs', type=int, default=(os.cpu_count() or 1), help='Number of worker processes (Defaults to # of CPUs or 1 if cannot be determined).')
+    return p, p.parse_args()
+
+def make_thumbnails(path, size, auto_mask=True, flatten_objects=False):
+    # Runs in the worker. Only the thumbnails are sent back to the parent.
+    try:
+        with contextlib.ExitStack() as stack:
+            mask_path = wipf.find_mask(path) if auto_mask else None
+            mask = None
+            if mask_path is not None:
+                mask = wipf.stream_wipf(stack.enter_context(wipf.open_file(mask_path)), mask_path, raw=True, verbose=False)
+            header, object_headers, objects = wipf.stream_wipf(stack.enter_context(wipf.open_file(path)), path, mask=mask, verbose=False)
+            if flatten_objects:
+                image = wipf.flatten({'header': header, 'object_headers': object_headers, 'objects': [wip_object['image'] for wip_object in objects]})
+                objects = [{'object_header': image['object_headers'][0], 'image': image['objects'][0]}]
+                del image
+            name = os.path.basename(path)
+            multi = not flatten_objects and len(object_headers) > 1
+            thumbnails = []
+            # Objects are shrunk as soon as they are decoded so only one full-size object is alive at a time
+            for wip_object in objects:
+                objhdr, obj = wip_object['object_header'], wip_object['image']
+                del wip_object
+                if obj.mode not in ('RGB', 'RGBA'):
+                    obj = obj.convert('RGBA')
+                obj.thumbnail((size, size))
+                label = f'{name} #{len(thumbnails)}' if multi else name
+                thumbnails.append((obj, label, f'{objhdr.dimension.x}x{objhdr.dimension.y} {header.depth}bpp'))
+                del obj
+    except Exception as e:
+        return path, None, f'{type(e).__name__}: {e}'
+    return path, thumbnails, None
+
+def bounded_map(exe, fn, iterable, limit):
+    # Like Executor.map() but keeps at most `limit` results in flight
+    pending = []
+    for args in iterable:
+        pending.append(exe.submit(fn, *args))
+        if len(pending) >= limit:
+            yield pending.pop(0).result()
+    for future in pending:
+        yield future.result()
+
+class ContactSheetWriter:
+    def __init__(self, output, size, columns, rows):
+        self.output = output
+        self.size = size
+        self.columns = columns
+        self.rows = rows
+        self.cell_width = size + PADDING * 2
+        self.cell_height = size + LABEL_LINE_HEIGHT * LABEL_LINES + PADDING * 2
+        self.font = ImageFont.load_default()
+        self.page = None
+        self.draw = None
+        self.page_number = 0
+        self.cell = 0
+
+    def _new_page(self):
+        self.page = Image.new('RGB', (self.cell_width * self.columns, self.cell_height * self.rows), BACKGROUND)
+        self.draw = ImageDraw.Draw(self.page)
+        self.cell = 0
+
+    def add(self, thumbnail, *labels):
+        if self.page is None:
+            self._new_page()
+        x = (self.cell % self.columns) * self.cell_width + PADDING
+        y = (self.cell // self.columns) * self.cell_height + PADDING
+        offset_x = (self.size - thumbnail.width) // 2
+        offset_y = (self.size - thumbnail.height) // 2
+        self.page.paste(thumbnail, (x + offset_x, y + offset_y), thumbnail if thumbnail.mode == 'RGBA' else None)
+        for i, label in enumerate(labels[:LABEL_LINES]):
+            self.draw.text((x, y + self.size + i * LABEL_LINE_HEIGHT), label, fill=(255, 255, 255), font=self.font)
+        self.cell += 1
+        if self.cell == self.columns * self.rows:
+            self.flush()
+
+    def flush(self):
+        if self.page is None:
+            return
+        filename = self.output.format(page=self.page_number)
+        self.page.save(filename)
+        print(f'Wrote {filename}')
+        self.page = None
+        self.draw = None
+        self.page_number += 1
+
+if __name__ == '__main__':
+    p, args = parse_args()
+    if args.columns <= 0 or args.rows <= 0 or args.size <= 0:
+        p.error('Size, columns and rows must be positive.')
+
+    sheet = ContactSheetWriter(args.output, args.size, args.columns, args.rows)
+    tasks = ((path, args.size, not args.no_mask, args.flatten) for path in wipf.expand_inputs(args.input))
+    with futures.ProcessPoolExecutor(max_workers=args.jobs, initializer=wipf.init_worker) as exe:
+        for path, thumbnails, error in bounded_map(exe, make_thumbnails, tasks, args.jobs * 4):
+            if error is not None:
+                print(f'** Failed to load {path}: {error}')
+                continue
+            for thumbnail, label, info in thumbnails:
+                sheet.add(thumbnail, label, info)
+    sheet.flush()
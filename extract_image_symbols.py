@@ -1,33 +1,96 @@
 #!/usr/bin/env python3
 # Extract WillPlus image symbols from Ren'Py lint on op2rpy results.
-import re
+import argparse
 import json
+import os
+import re
 import sys
 
 NOT_AN_IMAGE_PATTERN = re.compile(r"rpy:\d+ '(.+)' is not an image\.$")
+# e.g. "Play sound uses file 'se/SE001.ogg', which is not loadable."
+NOT_LOADABLE_PATTERN = re.compile(r"rpy:\d+ (.+) uses file '(.+)', which is not loadable\.$")
+
+def parse_args():
+    p = argparse.ArgumentParser(usage=(
+        '%(prog)s <Lint Log> <Reference File>\n'
+        '       %(prog)s [Lint Log]... -o <Reference File> [-m] [-d <Delta File>] [-f <Missing Files>]'
+    ))
+    p.add_argument('paths', nargs='*', help='Lint logs (- for stdin, which is the default). Without -o the last path is the reference file to write.')
+    p.add_argument('-o', '--output', help='Reference file to write.')
+    p.add_argument('-m', '--merge', action='store_true', help='Keep references already in the reference file.')
+    p.add_argument('-d', '--delta', help='Also write references that are not in the existing reference file to this file (same format, e.g. for prepare_assets.py --append).')
+    p.add_argument('-f', '--missing-files', help='Write files reported as not loadable (e.g. audio) to this file, grouped by statement.')
+    args = p.parse_args()
+    if args.output is None:
+        if len(args.paths) != 2:
+            p.error('Expecting exactly one log and one reference file without -o.')
+        args.output = args.paths.pop()
+    if len(args.paths) == 0:
+        args.paths.append('-')
+    return p, args
+
+def scan_log(f, images, missing_files, stats):
+    for line in f:
+        stats['lines'] += 1
+        line = line.rstrip()
+        m = NOT_AN_IMAGE_PATTERN.search(line)
+        if m is not None:
+            stats['image_references'] += 1
+            ref = m.group(1).split(' ')
+            if len(ref) == 2:
+                images.setdefault(ref[0], set()).add(ref[1])
+                stats['extracted_references'] += 1
+            continue
+        m = NOT_LOADABLE_PATTERN.search(line)
+        if m is not None:
+            missing_files.setdefault(m.group(1).lower(), set()).add(m.group(2))
+            stats['missing_files'] += 1
+
+def load_references(path):
+    if not os.path.isfile(path):
+        return {}
+    with open(path, 'r') as f:
+        return {k: set(v) for k, v in json.load(f).items()}
+
+def merge_references(references, other):
+    for k, v in other.items():
+        references.setdefault(k, set()).update(v)
+    return references
+
+def new_references(references, existing):
+    delta = {}
+    for k, v in references.items():
+        new = v - existing.get(k, set())
+        if len(new) != 0:
+            delta[k] = new
+    return delta
+
+def dump_references(path, references):
+    with open(path, 'w') as f:
+        json.dump({k: tuple(sorted(v)) for k, v in references.items()}, f, sort_keys=True, indent=4, separators=(',', ': '))
+
 if __name__ == '__main__':
-    extracted_references = 0
-    image_references = 0
-    lines = 0
+    p, args = parse_args()
+    stats = {'lines': 0, 'image_references': 0, 'extracted_references': 0, 'missing_files': 0}
     result = {}
-    with open(sys.argv[1], 'r') as f:
-        for line in f:
-            lines += 1
-            m = NOT_AN_IMAGE_PATTERN.search(line.rstrip())
-            if m is not None:
-                image_references += 1
-                ref = m.group(1).split(' ')
-                if len(ref) == 2:
-                    tag = result.get(ref[0])
-                    if tag is None:
-                        tag = set()
-                        result[ref[0]] = tag
-                    tag.add(ref[1])
-                    extracted_references += 1
-
-    for k, v in result.items():
-        result[k] = tuple(sorted(v))
-
-    with open(sys.argv[2], 'w') as f:
-        json.dump(result, f, sort_keys=True, indent=4, separators=(',', ': '))
-    print(f'Processed {lines} lines and found {image_references} image references. {extracted_references} of these references are extracted.')
+    missing_files = {}
+    for path in args.paths:
+        if path == '-':
+            scan_log(sys.stdin, result, missing_files, stats)
+        else:
+            with open(path, 'r') as f:
+                scan_log(f, result, missing_files, stats)
+
+    existing = load_references(args.output) if args.merge or args.delta is not None else {}
+    if args.delta is not None:
+        delta = new_references(result, existing)
+        dump_references(args.delta, delta)
+        print(f'{sum(len(v) for v in delta.values())} new reference(s) written to {args.delta}.')
+    if args.merge:
+        result = merge_references(existing, result)
+    dump_references(args.output, result)
+    if args.missing_files is not None:
+        dump_references(args.missing_files, missing_files)
+    print(f'Processed {stats["lines"]} lines and found {stats["image_references"]} image references. {stats["extracted_references"]} of these references are extracted.')
+    if stats['missing_files'] != 0:
+        print(f'Found {stats["missing_files"]} references to files that are not loadable.')
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+# Encode images as WIP/MSK files loadable by the engine (e.g. for translated title cards and UI).
+
+import argparse
+import os
+import sys
+
+from concurrent import futures
+from PIL import Image
+
+import wipf
+
+
+def parse_args():
+    p = argparse.ArgumentParser()
+    p.add_argument('input', nargs='+', help='Source images. Each one becomes an object of the output WIP (or its own WIP with --batch).')
+    p.add_argument('-o', '--output', required=True, help='Output WIP file (output directory with --batch).')
+    p.add_argument('-b', '--batch', action='store_true', help='Encode every input image as a separate WIP named after the image.')
+    p.add_argument('-d', '--depth', type=int, choices=(8, 24), help='Bit-depth of the output (defaults to 8 for palette/grayscale images and 24 otherwise, or the depth of the template).')
+    p.add_argument('-t', '--template', help='Copy bit-depth, object positions and layers from this WIP (a directory or ARC archive with same-name WIPs with --batch).')
+    p.add_argument('--position', action='append', help='Object position as XxY (repeat for each object, overrides --template).')
+    p.add_argument('-M', '--mask', action='store_true', help='Also write the alpha channel to a MSK file next to the output.')
+    p.add_argument('-l', '--level', type=int, default=wipf.LZSS_MAX_CHAIN, help=f'Match candidates examined per byte. Higher is slower but smaller (defaults to {wipf.LZSS_MAX_CHAIN}).')
+    p.add_argument('--no-verify', action='store_true', help='Skip decoding the compressed objects again for verification.')
+    p.add_argument('-j', '--jobs', type=int, default=(os.cpu_count() or 1), help='Number of worker processes (Defaults to # of CPUs or 1 if cannot be determined).')
+    args = p.parse_args()
+    if args.position is not None:
+        if args.batch:
+            p.error('--position cannot be used with --batch.')
+        if len(args.position) != len(args.input):
+            p.error('Expecting one --position for each input.')
+    return p, args
+
+def parse_position(position):
+    x, _, y = position.lower().partition('x')
+    return int(x), int(y)
+
+def read_template(path):
+    with wipf.open_file(path) as f:
+        header, object_headers = wipf.read_header(f)
+    return header, object_headers
+
+def find_template(template_dir, name):
+    matches = wipf.directory_index(template_dir).get(name.upper(), {}).get('WIP', ())
+    return matches[0] if len(matches) != 0 else None
+
+def default_depth(images):
+    return 8 if all(image.mode in ('P', 'L', '1') for image in images) else 24
+
+def encode_file(inputs, output, depth=None, template=None, positions=None, mask=False, max_chain=wipf.LZSS_MAX_CHAIN, verify=True, executor=None):
+    images = [Image.open(path) for path in inputs]
+    for image in images:
+        image.load()
+    layers = None
+    if template is not None:
+        header, object_headers = read_template(template)
+        if len(object_headers) != len(images):
+            raise ValueError(f'Template {template} has {len(object_headers)} object(s), got {len(images)} image(s).')
+        if depth is None:
+            depth = header.depth
+        if positions is None:
+            positions = [(objhdr.position.x, objhdr.position.y) for objhdr in object_headers]
+        layers = [objhdr.unk for objhdr in object_headers]
+    if depth is None:
+        depth = default_depth(images)
+
+    output_dir = os.path.dirname(output)
+    if len(output_dir) != 0:
+        os.makedirs(output_dir, exist_ok=True)
+    outputs = [output]
+    with open(output, 'wb') as f:
+        wipf.write_wipf(f, images, depth, positions, layers, executor, max_chain, verify)
+    if mask:
+        stem, _, _ = output.rpartition('.')
+        mask_output = f'{stem or output}.MSK'
+        with open(mask_output, 'wb') as f:
+            wipf.write_wipf(f, [wipf.mask_from_alpha(image) for image in images], 8, positions, layers, executor, max_chain, verify)
+        outputs.append(mask_output)
+    return outputs
+
+def _encode_task(path, output, options):
+    try:
+        return path, encode_file([path], output, **options), None
+    except Exception as e:
+        return path, None, f'{type(e).__name__}: {e}'
+
+def encode_batch(inputs, output_dir, depth=None, template_dir=None, mask=False, max_chain=wipf.LZSS_MAX_CHAIN, verify=True, jobs=None):
+    tasks = []
+    for path in inputs:
+        name, _, _ = os.path.basename(path).rpartition('.')
+        template = find_template(template_dir, name) if template_dir is not None else None
+        options = {'depth': depth, 'template': template, 'mask': mask, 'max_chain': max_chain, 'verify': verify}
+        tasks.append((path, os.path.join(output_dir, f'{name.upper()}.WIP'), options))
+    if len(tasks) == 0:
+        return
+    with futures.ProcessPoolExecutor(max_workers=jobs) as exe:
+        yield from exe.map(_encode_task, *zip(*tasks))
+
+if __name__ == '__main__':
+    p, args = parse_args()
+    verify = not args.no_verify
+    if args.batch:
+        failed = 0
+        for path, outputs, error in encode_batch(args.input, args.output, args.depth, args.template, args.mask, args.level, verify, args.jobs):
+            if error is not None:
+                failed += 1
+                print(f'{path}: {error}')
+            else:
+                print(f'{path}: {", ".join(outputs)}')
+        if failed != 0:
+            sys.exit(1)
+    else:
+        positions = [parse_position(position) for position in args.position] if args.position is not None else None
+        with futures.ProcessPoolExecutor(max_workers=args.jobs) as exe:
+            outputs = encode_file(args.input, args.output, args.depth, args.template, positions, args.mask, args.level, verify, exe)
+        print(', '.join(outputs))
@@ -1,97 +1,558 @@
 #!/usr/bin/env python3
 
 import argparse
-import fnmatch
+import hashlib
 import json
-import subprocess
-import uuid
 import os
+import posixpath
 import re
-import sys
-import tempfile
 
-from concurrent import futures
+from PIL import Image
 
+import profiling
+import wipf
+import will_arc
 
-FNMATCH_ESCAPE = re.compile(r'([\*\?\[\]])')
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
-def _fnmatch_escape(filename):
-    return FNMATCH_ESCAPE.sub(r'[\1]', filename)
+CACHE_FILENAME = '.prepare_assets_cache.json'
+CACHE_VERSION = 2
+# Sprites whose names only differ in an underscore-separated trailing number are layering candidates, e.g. expressions
+# ST01A_01, ST01A_02 of sprite ST01A. Digits without a separator are part of the name, so ST0101 and ST0201 or CG01 and CG02
+# don't end up in one group.
+LAYER_NAME_PATTERN = r'(.+)_\d+'
+# Variants changing more than this share of the image are stored in full
+LAYER_MAX_DELTA = 0.5
+# Caps the number of decoded variants a worker holds at once
+LAYER_GROUP_LIMIT = 32
+
 
 def parse_args():
     p = argparse.ArgumentParser()
     p.add_argument('reference_file', help='Path to reference file.')
-    p.add_argument('search_path', nargs='+', help='Search path. Multiple possible.')
+    p.add_argument('search_path', nargs='+', help='Search path (directory or ARC archive). Multiple possible.')
     p.add_argument('-o', '--output-dir', help='Output directory.')
-    p.add_argument('-w', '--wipf-py', default='./wipf.py', help='Specify wipf.py path (Defaults to ./wipf.py)')
-    p.add_argument('-p', '--wipf-py-python-exe', default=sys.executable, help='Specify python runtime for wipf.py (Defaults to the same as we are using).')
-    p.add_argument('-j', '--jobs', default=(os.cpu_count() or 1), help='Override number of parallel wipf.py jobs (Defaults to # of CPUs or 1 if cannot be determined).')
-    return p, p.parse_args()
+    p.add_argument('-a', '--append', action='store_true', help='Append to existing Ren\'Py listings instead of rewriting them (for delta reference files from extract_image_symbols.py -d).')
+    p.add_argument('--dedup', action='store_true', help='Convert identical images only once and point Ren\'Py image definitions of duplicates at the same file.')
+    p.add_argument('--layer-sprites', action='store_true', help='Store same-size variants of a sprite (e.g. expressions) as one base image plus cropped deltas, composited by Ren\'Py. Requires NumPy.')
+    p.add_argument('--layer-pattern', default=LAYER_NAME_PATTERN, help=f'Regular expression matching a whole sprite name. Sprites with the same first group are layered together (defaults to {LAYER_NAME_PATTERN}).')
+    p.add_argument('--no-cache', action='store_true', help='Convert everything even when a previous run left up-to-date outputs.')
+    p.add_argument('-e', '--encode-threads', type=int, default=2, help='WebP encoder threads per conversion job. Images are decoded while earlier ones are still being encoded (0 disables, defaults to 2).')
+    p.add_argument('--profile', metavar='REPORT', help='Record time spent per file and stage and write a report (.json or .csv).')
+    p.add_argument('-j', '--jobs', type=int, default=(os.cpu_count() or 1), help='Override number of parallel conversion jobs (Defaults to # of CPUs or 1 if cannot be determined).')
+    args = p.parse_args()
+    if args.layer_sprites and numpy is None:
+        p.error('--layer-sprites requires NumPy.')
+    return p, args
+
+def _hash_file(path):
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(will_arc.COPY_CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def file_signature(path, previous=None):
+    arc_path, member = will_arc.split_arc_path(path)
+    if arc_path is not None:
+        # Archives change as a whole, so always compare members by content
+        name, _, type_ = member.rpartition('.')
+        payload = wipf.open_archive(arc_path)[type_, name]
+        try:
+            return {'size': len(payload), 'hash': hashlib.blake2b(payload, digest_size=16).hexdigest()}
+        finally:
+            payload.release()
+    st = os.stat(path)
+    signature = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+    # Only rehash when the file was touched but kept its size
+    if previous is not None and previous.get('size') == st.st_size and previous.get('mtime_ns') == st.st_mtime_ns:
+        signature['hash'] = previous['hash']
+    else:
+        signature['hash'] = _hash_file(path)
+    return signature
+
+def input_signatures(source, mask):
+    signatures = {'source': None, 'mask': None}
+    for key, path in (('source', source), ('mask', mask)):
+        if path is not None:
+            signatures[key] = file_signature(path)
+            signatures[key]['path'] = os.path.abspath(path)
+    return signatures
+
+class ConversionCache:
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.dirty = False
+        if path is not None and os.path.isfile(path):
+            with open(path, 'r') as f:
+                cache = json.load(f)
+            if cache.get('version') == CACHE_VERSION:
+                self.entries = cache['entries']
+
+    def _key(self, source, options):
+        # The same file may be listed under several tags
+        return f'{options["tag"]}:{os.path.abspath(source)}'
+
+    def _check_signature(self, path, signature):
+        current = file_signature(path, signature)
+        if current['hash'] != signature['hash']:
+            return False
+        if current.get('mtime_ns') != signature.get('mtime_ns'):
+            # Touched but unchanged. Remember the new mtime so it won't be rehashed next time.
+            signature.update(current)
+            self.dirty = True
+        return True
+
+    def _check_inputs(self, inputs):
+        # Inputs of the conversion that produced an output reused through deduplication
+        try:
+            for signature in (inputs['source'], inputs['mask']):
+                if signature is not None and not self._check_signature(signature['path'], signature):
+                    return False
+        except FileNotFoundError:
+            return False
+        return True
+
+    def lookup(self, source, mask, options):
+        entry = self.entries.get(self._key(source, options))
+        if entry is None or entry['options'] != options:
+            return None
+        if not self._check_signature(source, entry['source']):
+            return None
+        if entry['mask'] is None:
+            if mask is not None:
+                return None
+        elif mask is None or os.path.abspath(mask) != entry['mask']['path'] or not self._check_signature(mask, entry['mask']):
+            return None
+        for output in entry['outputs']:
+            if not os.path.isfile(output['filename']) or os.path.getsize(output['filename']) != output['size']:
+                return None
+            if 'origin' in output and not self._check_inputs(output['origin']):
+                return None
+        return entry
+
+    def store(self, result, options, inputs=None):
+        if inputs is None:
+            inputs = input_signatures(result['source'], result['mask'])
+        source_signature = dict(inputs['source'])
+        del source_signature['path']
+        self.entries[self._key(result['source'], options)] = {
+            'options': options,
+            'source': source_signature,
+            'mask': inputs['mask'],
+            'outputs': [dict(obj, size=os.path.getsize(obj['filename'])) for obj in result['objects']],
+            'renpy': result['renpy'],
+        }
+        self.dirty = True
+
+    def save(self):
+        if self.path is None or not self.dirty:
+            return
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': CACHE_VERSION, 'entries': self.entries}, f)
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+
+def renpy_lines(objects):
+    return [line for obj in objects for line in wipf.renpy_image_metadata(obj['renpy_id'], obj['renpy_path'], obj['position'])]
+
+def reuse_outputs(source, mask, tag, objects):
+    # Result for a file whose outputs were produced by another conversion
+    image_id = os.path.basename(source).rpartition('.')[0].upper()
+    result = {'source': source, 'mask': mask, 'objects': [], 'renpy': []}
+    for obj in objects:
+        result['objects'].append(dict(obj, renpy_id=wipf.renpy_image_id(image_id, obj['index'], tag)))
+    result['renpy'] = renpy_lines(result['objects'])
+    return result
+
+class Deduplicator:
+    # Reuses outputs of identical images across tags and archives. Inputs are matched by WIP and mask
+    # content before converting, outputs by decoded pixels afterwards (duplicate files are removed).
+    def __init__(self):
+        self.by_input = {}
+        self.by_pixels = {}
+
+    @staticmethod
+    def input_key(inputs):
+        return tuple(signature['hash'] if signature is not None else None for signature in (inputs['source'], inputs['mask']))
+
+    def register(self, inputs, objects):
+        if any('renpy_path' not in obj for obj in objects):
+            # Cached before deduplication was enabled
+            return
+        # Remember which inputs produced each output so reuses can be validated by the cache later
+        objects = [dict(obj, origin=obj.get('origin', inputs)) for obj in objects]
+        self.by_input.setdefault(self.input_key(inputs), objects)
+        for obj in objects:
+            if 'pixel_hash' in obj:
+                self.by_pixels.setdefault(obj['pixel_hash'], obj)
+
+    def find(self, inputs):
+        return self.by_input.get(self.input_key(inputs))
+
+    def merge(self, result, inputs):
+        # Point objects of a fresh conversion at earlier outputs with the same pixels
+        objects = []
+        for obj in result['objects']:
+            canonical = self.by_pixels.get(obj['pixel_hash'])
+            if canonical is not None and canonical['filename'] != obj['filename']:
+                os.remove(obj['filename'])
+                obj = dict(obj, filename=canonical['filename'], renpy_path=canonical['renpy_path'], origin=canonical['origin'])
+            objects.append(obj)
+        result['objects'] = objects
+        result['renpy'] = renpy_lines(objects)
+        self.register(inputs, objects)
+        return result
+
+class TagListing:
+    # Collects the Ren'Py lines of a tag in reference order until all of its files are done
+    def __init__(self, tag, listing_dir, append=False):
+        self.tag = tag
+        self.path = os.path.join(listing_dir, f'{tag}list.rpy')
+        self.append = append
+        self.lines = {}
+        self.pending = 0
+
+    def add(self, order, lines):
+        self.lines[order] = lines
+
+    def write(self):
+        with profiling.stage('listing', self.path):
+            append = self.append and os.path.isfile(self.path)
+            with open(self.path, 'a' if append else 'w') as rpy:
+                if not append:
+                    rpy.write('init:\n')
+                for order in sorted(self.lines):
+                    for line in self.lines[order]:
+                        rpy.write(f'  {line}\n')
+        print(f"=> Wrote Ren'Py assets listing for image tag {self.tag}.")
 
 def find_files(search_paths, symbols):
-    listings = {sp: os.listdir(sp) for sp in search_paths}
+    indices = [wipf.directory_index(sp) for sp in search_paths]
     for symbol in symbols:
-        symbol_match = _fnmatch_escape(symbol)
-        symbol_match = ''.join(f'[{c.upper()}{c.lower()}]' if c.isascii() and c.isalpha() else c for c in symbol_match)
-        for prefix, files in listings.items():
-            # Look for WIP first
-            matches = fnmatch.filter(files, f'{symbol_match}.[Ww][Ii][Pp]')
-            if len(matches) != 0:
-                if len(matches) > 1:
-                    print('** Case-insensitive match found more than 1 file. Selecting the first found.')
-                yield symbol, os.path.join(prefix, matches[0])
+        for index in indices:
+            entry = index.get(symbol.upper())
+            if entry is None:
                 continue
-            # Fallback to MSK if no WIP found
-            matches = fnmatch.filter(files, f'{symbol_match}.[Mm][Ss][Kk]')
-            if len(matches) != 0:
+            # Look for WIP first, fallback to MSK if no WIP found
+            matches = entry.get('WIP') or entry.get('MSK')
+            if matches:
                 if len(matches) > 1:
                     print('** Case-insensitive match found more than 1 file. Selecting the first found.')
-                yield symbol, os.path.join(prefix, matches[0])
+                yield symbol, matches[0]
                 continue
 
-def process_file(tag, symbol, archive_name, in_path, out_path, rpy_path, wipf_py_python, wipf_py_path):
-    args = (wipf_py_python,
-            wipf_py_path,
-            '--webp',
-            '-M',
-            '-r', os.path.join(rpy_path, f'{str(uuid.uuid1())}.rpy'),
-            '-c', tag,
-            '-p', archive_name,
-            '-o', os.path.join(out_path, f'{symbol}_{{index}}.webp'),
-            in_path,)
+def source_size(path):
+    arc_path, member = will_arc.split_arc_path(path)
+    if arc_path is None:
+        return os.path.getsize(path)
+    name, _, type_ = member.rpartition('.')
+    return wipf.open_archive(arc_path).entry(type_, name).data_size
 
-    print('==>', args)
-    subprocess.run(args)
+def _load_rgba(path, mask_path):
+    mask = None
+    if mask_path is not None:
+        with wipf.open_file(mask_path) as f:
+            mask = wipf.load_wipf(f, mask_path, raw=True, verbose=False)
+    with wipf.open_file(path) as f:
+        image = wipf.load_wipf(f, path, mask=mask, verbose=False)
+    objhdr = image['object_headers'][0]
+    array = numpy.array(image['objects'][0].convert('RGBA'))
+    # Colors of invisible pixels don't count as changes
+    array[array[..., 3] == 0] = 0
+    return array, (objhdr.position.x, objhdr.position.y)
+
+def _diff_box(a, b):
+    # Bounding box (top, bottom, left, right) of the pixels that differ, None when identical
+    changed = (a != b).any(axis=2)
+    rows = numpy.flatnonzero(changed.any(axis=1))
+    if len(rows) == 0:
+        return None
+    cols = numpy.flatnonzero(changed.any(axis=0))
+    return rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+
+def _box_area(box):
+    return 0 if box is None else (box[1] - box[0]) * (box[3] - box[2])
+
+def _save_webp(array, filename, source):
+    with profiling.stage('save', source, array.nbytes):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        Image.fromarray(array).save(filename, 'WebP', lossless=True)
+
+def layer_sprites(sprites):
+    # Runs in the worker. The variant with the smallest changes to all others becomes the base.
+    # Others are stored as the bounding box of their changes with unchanged pixels left transparent,
+    # unless drawing that over the base would not reproduce them exactly (or the box is too large).
+    images = []
+    positions = []
+    for sprite in sprites:
+        image, position = _load_rgba(sprite['source'], sprite['mask'])
+        images.append(image)
+        positions.append(position)
+    height, width = images[0].shape[:2]
+    with profiling.stage('layer', sprites[0]['source'], sum(image.nbytes for image in images)):
+        boxes = {}
+        for i in range(len(images)):
+            for j in range(i + 1, len(images)):
+                boxes[i, j] = boxes[j, i] = _diff_box(images[i], images[j])
+        base = min(range(len(images)), key=lambda i: sum(_box_area(boxes[i, j]) for j in range(len(images)) if j != i))
+
+    results = []
+    for i, sprite in enumerate(sprites):
+        result = {'source': sprite['source'], 'mask': sprite['mask'], 'objects': [], 'renpy_path': sprite['renpy_path'], 'layers': None}
+        box = boxes.get((i, base))
+        if i != base and box is None:
+            # Same pixels as the base
+            result['renpy_path'] = sprites[base]['renpy_path']
+            result['objects'].append({'index': 0, 'filename': sprites[base]['filename'], 'position': positions[i], 'dimension': (width, height)})
+            results.append(result)
+            continue
+        if i != base and _box_area(box) <= width * height * LAYER_MAX_DELTA:
+            top, bottom, left, right = box
+            delta = images[i][top:bottom, left:right].copy()
+            below = images[base][top:bottom, left:right]
+            changed = (delta != below).any(axis=2)
+            # Straight alpha "over" only reproduces opaque pixels, or any pixel over a transparent one
+            if ((delta[..., 3] == 255) | (below[..., 3] == 0))[changed].all():
+                delta[~changed] = 0
+                _save_webp(delta, sprite['filename'], sprite['source'])
+                result['layers'] = [((0, 0), sprites[base]['renpy_path']), ((int(left), int(top)), sprite['renpy_path'])]
+                result['objects'].append({'index': 0, 'filename': sprites[base]['filename'], 'position': positions[i], 'dimension': (width, height)})
+                result['objects'].append({'index': 0, 'filename': sprite['filename'], 'position': positions[i], 'dimension': (int(right - left), int(bottom - top))})
+                results.append(result)
+                continue
+        _save_webp(images[i], sprite['filename'], sprite['source'])
+        result['objects'].append({'index': 0, 'filename': sprite['filename'], 'position': positions[i], 'dimension': (width, height)})
+        results.append(result)
+    return results
+
+def _layer_task(sprites):
+    # Runs on wipf.convert's workers next to the plain conversions
+    try:
+        result = {'sprites': layer_sprites(sprites)}
+    except Exception as e:
+        result = {'sprites': [{'source': sprite['source'], 'error': f'{type(e).__name__}: {e}'} for sprite in sprites]}
+    # Profile records travel back to the parent with the results
+    if profiling.enabled():
+        result['profile'] = profiling.drain()
+    return result
+
+def group_sprites(conversions, pattern):
+    # Single-object WIPs of the same archive, name pattern group, size and position. Returns (groups, others).
+    # Conversions sharing an output path (same file under several tags) stay together as one sprite.
+    sprites = {}
+    for conversion in conversions:
+        sprites.setdefault(conversion['options']['output'], []).append(conversion)
+    candidates = {}
+    others = []
+    for refs in sprites.values():
+        source = refs[0]['source']
+        if not source.upper().endswith('.WIP'):
+            others.extend(refs)
+            continue
+        with profiling.stage('discover', source):
+            with wipf.open_file(source) as f:
+                header, object_headers = wipf.read_header(f)
+        if len(object_headers) != 1:
+            others.extend(refs)
+            continue
+        objhdr = object_headers[0]
+        m = re.fullmatch(pattern, refs[0]['fields']['symbol'], re.IGNORECASE)
+        name = (m.group(1) if m is not None else refs[0]['fields']['symbol']).upper()
+        key = (refs[0]['fields']['archive'], name, (objhdr.dimension.x, objhdr.dimension.y), (objhdr.position.x, objhdr.position.y))
+        candidates.setdefault(key, []).append(refs)
+    groups = []
+    for members in candidates.values():
+        if len(members) < 2:
+            for refs in members:
+                others.extend(refs)
+            continue
+        for i in range(0, len(members), LAYER_GROUP_LIMIT):
+            groups.append(members[i:i+LAYER_GROUP_LIMIT])
+    return groups, others
+
+def _layered_renpy(result, tag, position):
+    image_id = wipf.renpy_image_id(os.path.basename(result['source']).rpartition('.')[0].upper(), 0, tag)
+    if result['layers'] is not None:
+        size = result['objects'][0]['dimension']
+        return wipf.renpy_composite_metadata(image_id, size, result['layers'], position)
+    return wipf.renpy_image_metadata(image_id, result['renpy_path'], position)
+
+def prepare(refs, search_paths, output_dir, jobs, cache, encode_threads=2, dedup=None, append=False, layer_pattern=None):
+    # All tags share one conversion pool. Each listing is written as soon as the last file of its tag is done.
+    output_template = os.path.join(output_dir, '{archive}', '{symbol}_{index}.webp')
+    listing_dir = os.path.join(output_dir, 'Riopy', 'lists')
+    os.makedirs(listing_dir, exist_ok=True)
+    listings = {}
+    candidates = []
+    for tag, symbols in refs.items():
+        print(f'=> Processing references for image tag {tag}...')
+        listings[tag] = TagListing(tag, listing_dir, append)
+        with profiling.stage('discover'):
+            files = list(find_files(search_paths, symbols))
+        for order, (symbol, f) in enumerate(files):
+            fields = {'symbol': symbol, 'archive': wipf.archive_name(f), 'tag': tag}
+            options = {
+                'output': output_template.format(index='{index}', **fields),
+                'tag': tag,
+                'prefix': fields['archive'],
+            }
+            try:
+                mask = wipf.find_mask(f) if not f.lower().endswith('.msk') else None
+            except RuntimeError as e:
+                # Ambiguous masks only fail this file
+                print(f'** Failed to convert {f}: {type(e).__name__}: {e}')
+                continue
+            candidates.append({'tag': tag, 'order': order, 'source': f, 'mask': mask, 'fields': fields, 'options': options, 'inputs': None, 'followers': []})
+
+    groups = []
+    if layer_pattern is not None:
+        groups, candidates = group_sprites(candidates, layer_pattern)
+    layer_jobs = []
+    for group in groups:
+        # Any change to the group can change its base, so it is either cached as a whole or redone
+        outputs = sorted(refs[0]['options']['output'] for refs in group)
+        hits = []
+        for refs in group:
+            for conversion in refs:
+                conversion['options']['layers'] = outputs
+                with profiling.stage('cache', conversion['source']):
+                    hits.append((conversion, cache.lookup(conversion['source'], conversion['mask'], conversion['options'])))
+        if all(hit is not None for _, hit in hits):
+            for conversion, hit in hits:
+                print('==> (cached)', conversion['source'])
+                listings[conversion['tag']].add(conversion['order'], hit['renpy'])
+            continue
+        for refs in group:
+            for conversion in refs:
+                listings[conversion['tag']].pending += 1
+        layer_jobs.append(group)
+
+    conversions = []
+    # Output path (and input content with dedup) -> conversion producing it. Later files with the same key follow it.
+    queued = {}
+    for conversion in candidates:
+        f, options, listing = conversion['source'], conversion['options'], listings[conversion['tag']]
+        if dedup is not None:
+            options['dedup'] = True
+        with profiling.stage('cache', f):
+            hit = cache.lookup(f, conversion['mask'], options)
+        if hit is not None:
+            print('==> (cached)', f)
+            listing.add(conversion['order'], hit['renpy'])
+            if dedup is not None:
+                dedup.register({'source': dict(hit['source'], path=os.path.abspath(f)), 'mask': hit['mask']}, hit['outputs'])
+            continue
+        keys = [options['output']]
+        if dedup is not None:
+            with profiling.stage('dedup', f):
+                conversion['inputs'] = input_signatures(f, conversion['mask'])
+                objects = dedup.find(conversion['inputs'])
+            if objects is not None:
+                print('==> (duplicate)', f)
+                result = reuse_outputs(f, conversion['mask'], conversion['tag'], objects)
+                listing.add(conversion['order'], result['renpy'])
+                cache.store(result, options, conversion['inputs'])
+                continue
+            keys.append(dedup.input_key(conversion['inputs']))
+        listing.pending += 1
+        leader = next((queued[key] for key in keys if key in queued), None)
+        if leader is not None:
+            leader['followers'].append(conversion)
+            continue
+        for key in keys:
+            queued[key] = conversion
+        conversions.append(conversion)
+
+    for listing in listings.values():
+        if listing.pending == 0:
+            listing.write()
+
+    def finish(finished):
+        for c in finished:
+            listing = listings[c['tag']]
+            listing.pending -= 1
+            if listing.pending == 0:
+                listing.write()
+                cache.save()
+
+    # Largest groups first, like conversions below. Both kinds of work share wipf.convert's workers.
+    layer_jobs.sort(key=lambda group: sum(source_size(refs[0]['source']) for refs in group), reverse=True)
+    layer_tasks = []
+    for i, group in enumerate(layer_jobs):
+        sprites = []
+        for refs in group:
+            filename = refs[0]['options']['output'].format(index=0)
+            sprites.append({
+                'source': refs[0]['source'],
+                'mask': refs[0]['mask'],
+                'filename': filename,
+                'renpy_path': posixpath.join(refs[0]['options']['prefix'], os.path.basename(filename)),
+            })
+        layer_tasks.append((_layer_task, sprites, {'layer_group': i}))
+
+    # Largest files first so the slowest conversions don't end up at the tail
+    conversions.sort(key=lambda conversion: source_size(conversion['source']), reverse=True)
+    tasks = [(conversion['source'], dict(conversion['fields'], conversion=i)) for i, conversion in enumerate(conversions)]
+    results = wipf.convert(
+        tasks, output_template, jobs,
+        auto_mask=True, webp=True, export_renpy=True, renpy_image_tag='{tag}', renpy_image_prefix='{archive}',
+        encode_threads=encode_threads, hash_pixels=dedup is not None, ordered=False, extra_tasks=layer_tasks,
+    )
+    for result in results:
+        fields = result.pop('fields')
+        if 'layer_group' in fields:
+            for refs, sprite in zip(layer_jobs[fields['layer_group']], result['sprites']):
+                if 'error' in sprite:
+                    for conversion in refs:
+                        print(f'** Failed to convert {conversion["source"]}: {sprite["error"]}')
+                    finish(refs)
+                    continue
+                print('==> (layered)' if sprite['layers'] is not None else '==>', sprite['source'])
+                for conversion in refs:
+                    position = sprite['objects'][0]['position']
+                    layered = {'source': sprite['source'], 'mask': sprite['mask'], 'objects': sprite['objects'], 'renpy': _layered_renpy(sprite, conversion['tag'], position)}
+                    listings[conversion['tag']].add(conversion['order'], layered['renpy'])
+                    cache.store(layered, conversion['options'])
+                finish(refs)
+            continue
+        conversion = conversions[fields['conversion']]
+        if 'error' in result:
+            for c in [conversion] + conversion['followers']:
+                print(f'** Failed to convert {c["source"]}: {result["error"]}')
+        else:
+            print('==>', result['source'])
+            if dedup is not None:
+                with profiling.stage('dedup', result['source']):
+                    result = dedup.merge(result, conversion['inputs'])
+            listings[conversion['tag']].add(conversion['order'], result['renpy'])
+            with profiling.stage('cache', result['source']):
+                cache.store(result, conversion['options'], conversion['inputs'])
+            for follower in conversion['followers']:
+                print('==> (duplicate)', follower['source'])
+                objects = dedup.find(follower['inputs']) if dedup is not None else result['objects']
+                reused = reuse_outputs(follower['source'], follower['mask'], follower['tag'], objects)
+                listings[follower['tag']].add(follower['order'], reused['renpy'])
+                cache.store(reused, follower['options'], follower['inputs'])
+        finish([conversion] + conversion['followers'])
+    cache.save()
 
 if __name__ == '__main__':
     p, args = parse_args()
+    if args.profile is not None:
+        profiling.enable()
 
     with open(args.reference_file, 'r') as f:
         refs = json.load(f)
 
-    listing_dir = os.path.join(args.output_dir, 'Riopy', 'lists')
-    os.makedirs(listing_dir, exist_ok=True)
-
-    with tempfile.TemporaryDirectory() as work_dir:
-        for tag, symbols in refs.items():
-            print(f'=> Processing references for image tag {tag}...')
-            rpy_path = os.path.join(work_dir, tag)
-
-            os.makedirs(os.path.join(work_dir, tag), exist_ok=True)
-            files = find_files(args.search_path, symbols)
-            with futures.ThreadPoolExecutor(max_workers=args.jobs) as exe:
-                for symbol, f in files:
-                    prefix, _ = os.path.split(f)
-                    archive_name = os.path.basename(os.path.abspath(prefix if len(prefix) != 0 else '.'))
-                    out_path = os.path.join(args.output_dir, archive_name)
-                    os.makedirs(out_path, exist_ok=True)
-                    exe.submit(process_file, tag, symbol, archive_name, f, out_path, rpy_path, args.wipf_py_python_exe, args.wipf_py)
-            print(f"==> Generating Ren'Py assets listing...")
-            with open(os.path.join(listing_dir, f'{tag}list.rpy'), 'w') as rpy:
-                rpy.write('init:\n')
-                for fragfile in os.listdir(rpy_path):
-                    with open(os.path.join(rpy_path, fragfile)) as rpyfrag:
-                        for line in rpyfrag:
-                            rpy.write(f'  {line}')
-
+    cache = ConversionCache(None if args.no_cache else os.path.join(args.output_dir, CACHE_FILENAME))
+    dedup = Deduplicator() if args.dedup else None
+    prepare(refs, args.search_path, args.output_dir, args.jobs, cache, args.encode_threads, dedup, args.append, args.layer_pattern if args.layer_sprites else None)
+    if args.profile is not None:
+        profiling.write_report(args.profile)
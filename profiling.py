@@ -0,0 +1,96 @@
+# Opt-in per-stage timing (--profile) for wipf.py, will_arc.py and prepare_assets.py.
+# Records are collected per process. Worker processes hand theirs back with their results (see drain() and merge()).
+
+import contextlib
+import csv
+import json
+import os
+import time
+
+
+REPORT_FIELDS = ('file', 'stage', 'wall', 'cpu', 'bytes', 'pid')
+
+records = None
+start_time = None
+_disabled_stage = contextlib.nullcontext({})
+
+
+def enable():
+    global records, start_time
+    if records is None:
+        records = []
+        start_time = time.perf_counter()
+
+def enabled():
+    return records is not None
+
+@contextlib.contextmanager
+def _stage(name, file, nbytes):
+    record = {'file': file, 'stage': name, 'wall': 0.0, 'cpu': 0.0, 'bytes': nbytes, 'pid': os.getpid()}
+    wall = time.perf_counter()
+    # Per-thread CPU time since some stages run in thread pools
+    cpu = time.thread_time()
+    try:
+        yield record
+    finally:
+        record['wall'] = time.perf_counter() - wall
+        record['cpu'] = time.thread_time() - cpu
+        records.append(record)
+
+def stage(name, file=None, nbytes=0):
+    # The yielded record can be updated (e.g. record['bytes']) when sizes are only known afterwards.
+    if records is None:
+        return _disabled_stage
+    return _stage(name, file, nbytes)
+
+def drain():
+    global records
+    if records is None:
+        return []
+    drained, records = records, []
+    return drained
+
+def merge(other):
+    if records is not None:
+        records.extend(other)
+
+def summarize(records):
+    stages = {}
+    files = {}
+    for record in records:
+        for key, totals in ((record['stage'], stages), (record['file'], files)):
+            if key is None:
+                continue
+            entry = totals.setdefault(key, {'count': 0, 'wall': 0.0, 'cpu': 0.0, 'bytes': 0})
+            entry['count'] += 1
+            entry['wall'] += record['wall']
+            entry['cpu'] += record['cpu']
+            entry['bytes'] += record['bytes']
+    for entry in stages.values():
+        entry['mb_per_s'] = entry['bytes'] / entry['wall'] / 1e6 if entry['wall'] > 0 else 0.0
+    return stages, files
+
+def print_summary(stages, slowest, elapsed):
+    print(f'Profile ({elapsed:.2f}s elapsed, stage times are summed over all workers and threads):')
+    print(f'  {"Stage":<16} {"count":>8} {"wall":>10} {"cpu":>10} {"MB/s":>10}')
+    for name, entry in sorted(stages.items(), key=lambda e: e[1]['wall'], reverse=True):
+        print(f'  {name:<16} {entry["count"]:8d} {entry["wall"]:9.3f}s {entry["cpu"]:9.3f}s {entry["mb_per_s"]:10.2f}')
+    if len(slowest) != 0:
+        print('  Slowest files:')
+        for entry in slowest:
+            print(f'  {entry["wall"]:9.3f}s {entry["file"]}')
+
+def write_report(path, top=10):
+    # JSON gets the summary and all records, CSV only the records (one row per file and stage)
+    elapsed = time.perf_counter() - start_time
+    stages, files = summarize(records)
+    slowest = [{'file': f, **entry} for f, entry in sorted(files.items(), key=lambda e: e[1]['wall'], reverse=True)[:top]]
+    if path.lower().endswith('.csv'):
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, REPORT_FIELDS)
+            writer.writeheader()
+            writer.writerows(records)
+    else:
+        with open(path, 'w') as f:
+            json.dump({'elapsed': elapsed, 'stages': stages, 'slowest_files': slowest, 'records': records}, f, indent=4)
+    print_summary(stages, slowest, elapsed)
@@ -2,9 +2,25 @@
 
 import argparse
 import ctypes
+import errno
+import fnmatch
+import hashlib
+import io
+import json
+import mmap
 import os
+import sys
+import threading
+import time
 
 from collections import OrderedDict
+from concurrent import futures
+
+import profiling
+
+
+COPY_CHUNK_SIZE = 1024 * 1024
+MANIFEST_VERSION = 1
 
 
 class ARCTypeEntry(ctypes.LittleEndianStructure):
@@ -34,22 +50,58 @@ class ARCObjectEntryV2(ctypes.LittleEndianStructure):
     _pack_ = 1
 
 
-def parse_metadata(arc, version=1):
-    if version == 1:
-        ARCObjectEntry = ARCObjectEntryV1
-    elif version == 2:
-        ARCObjectEntry = ARCObjectEntryV2
-    else:
-        raise ValueError(f'Unknown version {version}.')
-    metadata = OrderedDict()
+ARC_OBJECT_ENTRY_TYPES = {
+    1: ARCObjectEntryV1,
+    2: ARCObjectEntryV2,
+}
+
+
+def intact_layouts(arc):
+    # Returns {version: unused bytes} for every object entry layout whose tables check out
+    arc_size = arc.seek(0, os.SEEK_END)
+    try:
+        layouts = {}
+        for version in ARC_OBJECT_ENTRY_TYPES:
+            metadata, problems, unused = check_tables(arc, version, arc_size)
+            if metadata is not None and len(problems) == 0:
+                layouts[version] = unused
+        return layouts
+    finally:
+        arc.seek(0)
+
+def detect_version(arc):
+    # Both layouts share the type list, and a misread one can still land every object inside the file
+    # (e.g. a V2 archive with one object per type read as V1). Only accept a layout when it is the
+    # only intact one, or the only one whose payloads cover the whole data block.
+    layouts = intact_layouts(arc)
+    if len(layouts) == 0:
+        raise ValueError('Unable to detect archive version.')
+    exact = [version for version, unused in layouts.items() if unused == 0]
+    if len(layouts) == 1:
+        return next(iter(layouts))
+    elif len(exact) == 1:
+        return exact[0]
+    raise ValueError(f'Archive layout is ambiguous (could be version {" or ".join(map(str, layouts))}), pass -v.')
+
+def read_type_table(arc):
     types = []
-    ntypes = int.from_bytes(arc.read(4), 'little')
+    ntypes = arc.read(4)
+    if len(ntypes) != 4:
+        raise EOFError('Unexpected end-of-file.')
+    ntypes = int.from_bytes(ntypes, 'little')
     for _ in range(ntypes):
         type_entry = ARCTypeEntry()
         if arc.readinto(type_entry) != ctypes.sizeof(type_entry):
             raise EOFError('Unexpected end-of-file.')
         types.append(type_entry)
-    for t in types:
+    return types
+
+def parse_metadata(arc, version=1):
+    ARCObjectEntry = ARC_OBJECT_ENTRY_TYPES.get(version)
+    if ARCObjectEntry is None:
+        raise ValueError(f'Unknown version {version}.')
+    metadata = OrderedDict()
+    for t in read_type_table(arc):
         objects = []
         metadata[t.name.decode('ascii')] = objects
         arc.seek(t.object_list_offset)
@@ -60,39 +112,241 @@ def parse_metadata(arc, version=1):
             objects.append(object_entry)
     return metadata
 
-def dump_files(arc, metadata, output_dir):
-    os.makedirs(output_dir, exist_ok=True)
+_read_lock = threading.Lock()
+
+def _read_at(src, size, offset):
+    if hasattr(os, 'pread'):
+        return os.pread(src.fileno(), size, offset)
+    # No positional read available. Serialize seek + read instead.
+    with _read_lock:
+        src.seek(offset)
+        return src.read(size)
+
+def _write_all(dst, data):
+    # Unbuffered files (e.g. in dump_object()) may write less than requested
+    view = memoryview(data)
+    while len(view) != 0:
+        written = dst.write(view)
+        if written is None or written == 0:
+            raise OSError(errno.EIO, 'Write made no progress.')
+        view = view[written:]
+
+def copy_range(src, dst, offset, size):
+    # Try in-kernel copy first and fall back to chunked copy when the filesystem doesn't support it.
+    if hasattr(os, 'copy_file_range'):
+        # Anything still sitting in the write buffer must land before the kernel appends to the file
+        dst.flush()
+        try:
+            while size > 0:
+                copied = os.copy_file_range(src.fileno(), dst.fileno(), min(size, COPY_CHUNK_SIZE), offset)
+                if copied == 0:
+                    raise EOFError('Unexpected end-of-file.')
+                offset += copied
+                size -= copied
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF):
+                raise
+    while size > 0:
+        chunk = _read_at(src, min(size, COPY_CHUNK_SIZE), offset)
+        if len(chunk) == 0:
+            raise EOFError('Unexpected end-of-file.')
+        _write_all(dst, chunk)
+        offset += len(chunk)
+        size -= len(chunk)
+
+def _match_filter(type_, name, only=None, include=None):
+    if only is not None and type_.upper() not in (t.upper() for t in only):
+        return False
+    if include is not None:
+        filename = f'{name}.{type_}'.upper()
+        return any(fnmatch.fnmatchcase(name.upper(), pattern.upper()) or fnmatch.fnmatchcase(filename, pattern.upper()) for pattern in include)
+    return True
+
+def select_objects(metadata, only=None, include=None):
+    selected = []
     for type_, objects in metadata.items():
         for object_entry in objects:
-            filename = os.path.join(output_dir, f'{object_entry.name.decode("ascii")}.{type_}')
-            with open(filename, 'wb') as f:
-                arc.seek(object_entry.data_offset)
-                # TODO chunked copy?
-                f.write(arc.read(object_entry.data_size))
+            if _match_filter(type_, object_entry.name.decode('ascii'), only, include):
+                selected.append((type_, object_entry))
+    # Extract in on-disk order so the archive is read sequentially
+    selected.sort(key=lambda e: e[1].data_offset)
+    return selected
 
-def build_metadata_from_files(input_dir, version=1):
-    metadata = OrderedDict()
-    filename_cache = {}
-    if version == 1:
-        name_limit = 8
-        ARCObjectEntry = ARCObjectEntryV1
-    elif version == 2:
-        name_limit = 12
-        ARCObjectEntry = ARCObjectEntryV2
+def dump_object(arc, type_, object_entry, output_dir):
+    name = f'{object_entry.name.decode("ascii")}.{type_}'
+    with profiling.stage('extract', name, object_entry.data_size):
+        with open(os.path.join(output_dir, name), 'wb', buffering=0) as f:
+            copy_range(arc, f, object_entry.data_offset, object_entry.data_size)
+
+def dump_files(arc, metadata, output_dir, only=None, include=None, jobs=1):
+    os.makedirs(output_dir, exist_ok=True)
+    selected = select_objects(metadata, only, include)
+    if jobs > 1:
+        with futures.ThreadPoolExecutor(max_workers=jobs) as exe:
+            for _ in exe.map(lambda e: dump_object(arc, e[0], e[1], output_dir), selected):
+                pass
     else:
+        for type_, object_entry in selected:
+            dump_object(arc, type_, object_entry, output_dir)
+    return len(selected)
+
+class ArcObjectReader(io.RawIOBase):
+    def __init__(self, view):
+        self._view = view
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        b = memoryview(b).cast('B')
+        chunk = self._view[self._pos:self._pos + len(b)]
+        b[:len(chunk)] = chunk
+        self._pos += len(chunk)
+        return len(chunk)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = len(self._view) + offset
+        else:
+            raise ValueError(f'Invalid whence {whence}.')
+        if pos < 0:
+            raise ValueError('Negative seek position.')
+        self._pos = pos
+        return pos
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        self._view.release()
+        super().close()
+
+
+class ArcArchive:
+    def __init__(self, arc_path, version=None):
+        self.path = arc_path
+        self._file = open(arc_path, 'rb')
+        try:
+            if version is None:
+                version = detect_version(self._file)
+            self.version = version
+            self.metadata = parse_metadata(self._file, version)
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception:
+            self._file.close()
+            raise
+        self._view = memoryview(self._mmap)
+        self.index = OrderedDict()
+        for type_, objects in self.metadata.items():
+            for object_entry in objects:
+                if object_entry.data_offset + object_entry.data_size > len(self._mmap):
+                    self.close()
+                    raise EOFError(f'Object {object_entry.name.decode("ascii")}.{type_} extends past end-of-file.')
+                self.index[(type_.upper(), object_entry.name.decode('ascii').upper())] = object_entry
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __contains__(self, key):
+        type_, name = key
+        return (type_.upper(), name.upper()) in self.index
+
+    def __getitem__(self, key):
+        type_, name = key
+        object_entry = self.index[(type_.upper(), name.upper())]
+        return self._view[object_entry.data_offset:object_entry.data_offset + object_entry.data_size]
+
+    def get(self, type_, name, default=None):
+        try:
+            return self[type_, name]
+        except KeyError:
+            return default
+
+    def entry(self, type_, name):
+        return self.index[(type_.upper(), name.upper())]
+
+    def filenames(self):
+        return [f'{name}.{type_}' for type_, name in self.index]
+
+    def open(self, filename):
+        name, _, type_ = filename.rpartition('.')
+        return ArcObjectReader(self[type_, name])
+
+    def close(self):
+        if self._view is not None:
+            self._view.release()
+            self._view = None
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        self._file.close()
+
+def split_arc_path(path):
+    # Treat paths like Chip.arc/NAME.WIP as a member of an archive
+    arc_path, member = os.path.split(path)
+    if arc_path.lower().endswith('.arc') and os.path.isfile(arc_path):
+        return arc_path, member
+    return None, path
+
+ARC_NAME_LIMITS = {
+    1: 8,
+    2: 12,
+}
+
+
+def object_key(filename, version=1):
+    name_limit = ARC_NAME_LIMITS.get(version)
+    if name_limit is None:
+        raise ValueError(f'Unknown version {version}.')
+    splitted = filename.split('.')
+    name, suffix = '.'.join(splitted[:-1]).upper().encode('ascii'), splitted[-1].upper()
+    if len(name) > name_limit or len(suffix) > 3:
+        raise RuntimeError(f'Filename {repr(filename)} too long.')
+    return suffix, name
+
+def scan_files(input_dir, version=1, jobs=1):
+    if version not in ARC_NAME_LIMITS:
         raise ValueError(f'Unknown version {version}.')
 
-    files = (f for f in os.listdir(input_dir) if os.path.isfile(os.path.join(input_dir, f)))
-    for f in files:
-        splitted = f.split('.')
-        name, suffix = '.'.join(splitted[:-1]).upper().encode('ascii'), splitted[-1].upper()
-        if len(name) > name_limit or len(suffix) > 3:
-            raise RuntimeError(f'Filename {repr(f)} too long.')
-        path = os.path.join(input_dir, f)
-        filename_cache[(suffix, name)] = path
+    with os.scandir(input_dir) as it:
+        entries = [e for e in it if e.is_file()]
+    # stat() results are cached on the DirEntry, so each file is only stat'ed once
+    if jobs > 1:
+        with futures.ThreadPoolExecutor(max_workers=jobs) as exe:
+            sizes = list(exe.map(lambda e: e.stat().st_size, entries))
+    else:
+        sizes = [e.stat().st_size for e in entries]
+
+    filename_cache = {}
+    for e, size in zip(entries, sizes):
+        filename_cache[object_key(e.name, version)] = (e.path, size)
+    return filename_cache
+
+def build_metadata(filename_cache, version=1):
+    metadata = OrderedDict()
+    ARCObjectEntry = ARC_OBJECT_ENTRY_TYPES.get(version)
+    if ARCObjectEntry is None:
+        raise ValueError(f'Unknown version {version}.')
     # Sort by suffix then object name beforehand
     filename_cache = OrderedDict(sorted(filename_cache.items(), key=lambda e: e[0]))
-    for sn, path in filename_cache.items():
+    for sn, source in filename_cache.items():
         suffix, name = sn
         objects = metadata.get(suffix)
         if objects is None:
@@ -100,13 +354,9 @@ def build_metadata_from_files(input_dir, version=1):
             metadata[suffix] = objects
         entry = ARCObjectEntry()
         entry.name = name
-        entry.data_size = os.path.getsize(path)
+        entry.data_size = source[1]
         objects.append(entry)
-    metadata_size = 4
-    metadata_size += ctypes.sizeof(ARCTypeEntry) * len(metadata)
-    for t in metadata.values():
-        metadata_size += sum(ctypes.sizeof(obj) for obj in t)
-    data_block_offset = metadata_size
+    data_block_offset = metadata_size(metadata)
     data_block_layout = []
     for type_, t in metadata.items():
         for obj in t:
@@ -115,6 +365,16 @@ def build_metadata_from_files(input_dir, version=1):
             data_block_offset += obj.data_size
     return metadata, data_block_layout
 
+def build_metadata_from_files(input_dir, version=1, jobs=1):
+    return build_metadata(scan_files(input_dir, version, jobs), version)
+
+def metadata_size(metadata):
+    size = 4
+    size += ctypes.sizeof(ARCTypeEntry) * len(metadata)
+    for t in metadata.values():
+        size += sum(ctypes.sizeof(obj) for obj in t)
+    return size
+
 def write_metadata(arc, metadata):
     arc.write(len(metadata).to_bytes(4, 'little'))
     metadata_offset = 4 + ctypes.sizeof(ARCTypeEntry) * len(metadata)
@@ -129,39 +389,372 @@ def write_metadata(arc, metadata):
         for obj in t:
             arc.write(obj)
 
-def write_data_block(arc, layout):
-    for fn in layout:
-        with open(fn, 'rb') as f:
-            arc.write(f.read())
+def write_data_block(arc, layout, progress=None):
+    total = sum(size for _, size in layout)
+    done = 0
+    for fn, size in layout:
+        with profiling.stage('copy', fn, size):
+            with open(fn, 'rb') as f:
+                copy_range(f, arc, 0, size)
+        done += size
+        if progress is not None:
+            progress(done, total)
 
-def unpack(arc_path, output_dir, version=1):
+def unpack(arc_path, output_dir, version=None, only=None, include=None, jobs=1):
     with open(arc_path, 'rb') as f:
-        metadata = parse_metadata(f, version)
-        dump_files(f, metadata, output_dir)
+        with profiling.stage('metadata', arc_path):
+            if version is None:
+                version = detect_version(f)
+            metadata = parse_metadata(f, version)
+        return dump_files(f, metadata, output_dir, only, include, jobs)
 
-def pack(input_dir, arc_path, version=1):
-    metadata, data_block_layout = build_metadata_from_files(input_dir, version)
+class ProgressReport:
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self.start = time.perf_counter()
+        self.last_report = self.start
+
+    def __call__(self, done, total):
+        now = time.perf_counter()
+        if now - self.last_report >= self.interval or done == total:
+            self.last_report = now
+            elapsed = now - self.start
+            rate = done / elapsed / 1048576 if elapsed > 0 else 0
+            percent = done * 100 / total if total != 0 else 100
+            print(f'{done / 1048576:.1f}/{total / 1048576:.1f} MiB ({percent:.1f}%), {rate:.1f} MiB/s')
+
+def pack(input_dir, arc_path, version=1, jobs=1, progress=False):
+    with profiling.stage('scan', input_dir):
+        metadata, data_block_layout = build_metadata_from_files(input_dir, version, jobs)
     with open(arc_path, 'wb') as f:
-        write_metadata(f, metadata)
-        write_data_block(f, data_block_layout)
+        with profiling.stage('metadata', arc_path):
+            write_metadata(f, metadata)
+        write_data_block(f, data_block_layout, ProgressReport() if progress else None)
+    if progress:
+        print(f'Packed {len(data_block_layout)} objects.')
+
+def _overlaps(entries, key, offset, size):
+    for other_key, other in entries.items():
+        if other_key != key and other.data_offset < offset + size and offset < other.data_offset + other.data_size:
+            return True
+    return False
+
+def verify_update(arc, metadata, updates, version=1):
+    arc.seek(0)
+    written = parse_metadata(arc, version)
+    arc_size = arc.seek(0, os.SEEK_END)
+    if [(t, [(o.name, o.data_offset, o.data_size) for o in objs]) for t, objs in written.items()] != \
+            [(t, [(o.name, o.data_offset, o.data_size) for o in objs]) for t, objs in metadata.items()]:
+        raise RuntimeError('Metadata mismatch after update.')
+    for type_, objects in written.items():
+        for obj in objects:
+            if obj.data_offset + obj.data_size > arc_size:
+                raise RuntimeError(f'Object {obj.name.decode("ascii")}.{type_} extends past end-of-file after update.')
+    for key, (fn, size) in updates.items():
+        entry = next(o for o in written[key[0]] if o.name == key[1])
+        with open(fn, 'rb') as f:
+            offset = 0
+            while offset < size:
+                chunk = f.read(min(size - offset, COPY_CHUNK_SIZE))
+                if _read_at(arc, len(chunk), entry.data_offset + offset) != chunk:
+                    raise RuntimeError(f'Payload mismatch for {fn} after update.')
+                offset += len(chunk)
+
+def update(arc_path, files, version=None, verify=True):
+    with open(arc_path, 'r+b') as arc:
+        layouts = intact_layouts(arc)
+        if version is None:
+            # Tables rewritten in the wrong layout destroy the archive, so don't settle for the best fit like detect_version()
+            if len(layouts) > 1:
+                raise ValueError(f'Archive layout is ambiguous (could be version {" or ".join(map(str, layouts))}), pass -v.')
+            elif len(layouts) == 0:
+                raise ValueError('Unable to detect archive version.')
+            version = next(iter(layouts))
+        elif version not in ARC_OBJECT_ENTRY_TYPES:
+            raise ValueError(f'Unknown version {version}.')
+        elif version not in layouts:
+            raise ValueError(f'Archive does not look like a version {version} archive.')
+        arc.seek(0)
+        ARCObjectEntry = ARC_OBJECT_ENTRY_TYPES[version]
+        updates = OrderedDict()
+        for fn in files:
+            updates[object_key(os.path.basename(fn), version)] = (fn, os.path.getsize(fn))
+
+        entries = {}
+        for type_, objects in parse_metadata(arc, version).items():
+            for obj in objects:
+                entries[(type_, obj.name)] = obj
+        new_entries = set()
+        for key in updates:
+            if key not in entries:
+                entry = ARCObjectEntry()
+                entry.name = key[1]
+                entries[key] = entry
+                new_entries.add(key)
+
+        # Keep the same suffix then object name ordering as pack()
+        metadata = OrderedDict()
+        for key in sorted(entries):
+            metadata.setdefault(key[0], []).append(entries[key])
+        tables_end = metadata_size(metadata)
+        end = arc.seek(0, os.SEEK_END)
+
+        # New entries grow the tables. Move payloads that would be overwritten to the end of the archive.
+        for key, entry in entries.items():
+            if key not in updates and entry.data_offset < tables_end:
+                arc.seek(end)
+                with profiling.stage('relocate', f'{key[1].decode("ascii")}.{key[0]}', entry.data_size):
+                    copy_range(arc, arc, entry.data_offset, entry.data_size)
+                entry.data_offset = end
+                end += entry.data_size
+
+        # Overwrite changed payloads in place when they fit, otherwise append them.
+        for key, (fn, size) in updates.items():
+            entry = entries[key]
+            if key not in new_entries and size <= entry.data_size and entry.data_offset >= tables_end and \
+                    not _overlaps(entries, key, entry.data_offset, entry.data_size):
+                offset = entry.data_offset
+            else:
+                offset = end
+                end += size
+            arc.seek(offset)
+            with profiling.stage('copy', fn, size):
+                with open(fn, 'rb') as f:
+                    copy_range(f, arc, 0, size)
+            entry.data_offset = offset
+            entry.data_size = size
+
+        arc.seek(0)
+        write_metadata(arc, metadata)
+        arc.flush()
+        if verify:
+            with profiling.stage('verify', arc_path, sum(size for _, size in updates.values())):
+                verify_update(arc, metadata, updates, version)
+    return metadata
+
+def check_tables(arc, version, arc_size):
+    # Returns (metadata, problems, unused bytes). Unused bytes are not a problem by themselves since update() leaves holes behind.
+    arc.seek(0)
+    try:
+        types = read_type_table(arc)
+        arc.seek(0)
+        metadata = parse_metadata(arc, version)
+    except EOFError:
+        return None, ['Tables extend past end-of-file.'], 0
+    problems = []
+    # Object lists follow the type list back to back, in type order
+    object_list_offset = 4 + ctypes.sizeof(ARCTypeEntry) * len(types)
+    names = set()
+    for t in types:
+        type_ = t.name.decode('ascii', 'replace')
+        if type_ in names:
+            problems.append(f'Type {type_} is listed more than once.')
+        names.add(type_)
+        if t.object_list_offset != object_list_offset:
+            problems.append(f'Object list of type {type_} is at offset {t.object_list_offset}, expecting {object_list_offset}.')
+        object_list_offset = t.object_list_offset + t.object_list_size * ctypes.sizeof(ARC_OBJECT_ENTRY_TYPES[version])
+    tables_end = metadata_size(metadata)
+
+    spans = []
+    keys = set()
+    for type_, objects in metadata.items():
+        for object_entry in objects:
+            name = f'{object_entry.name.decode("ascii", "replace")}.{type_}'
+            if name.upper() in keys:
+                problems.append(f'Object {name} is listed more than once.')
+            keys.add(name.upper())
+            if object_entry.data_offset < tables_end:
+                problems.append(f'Object {name} starts inside the tables (offset {object_entry.data_offset}).')
+            if object_entry.data_offset + object_entry.data_size > arc_size:
+                problems.append(f'Object {name} extends past end-of-file (offset {object_entry.data_offset}, size {object_entry.data_size}).')
+                # Would overlap everything after it
+                continue
+            spans.append((object_entry.data_offset, object_entry.data_offset + object_entry.data_size, name))
+    spans.sort()
+    covered = 0
+    end, last = tables_end, None
+    for span_start, span_end, name in spans:
+        if span_start < end and last is not None and span_start != span_end:
+            problems.append(f'Object {name} overlaps {last}.')
+        covered += max(0, span_end - max(span_start, end))
+        if span_end > end:
+            end, last = span_end, name
+    return metadata, problems, max(0, arc_size - tables_end - covered)
+
+def hash_payloads(arc_path, metadata, jobs=1):
+    # Payloads are hashed straight from the mapping, in on-disk order. hashlib releases the GIL on large buffers so threads hash in parallel.
+    selected = select_objects(metadata)
+    with open(arc_path, 'rb') as f:
+        arc_size = os.fstat(f.fileno()).st_size
+        if arc_size == 0:
+            return {}
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            if hasattr(m, 'madvise'):
+                m.madvise(mmap.MADV_SEQUENTIAL)
+            view = memoryview(m)
+
+            def _hash(entry):
+                type_, object_entry = entry
+                name = f'{object_entry.name.decode("ascii", "replace")}.{type_}'
+                if object_entry.data_offset + object_entry.data_size > arc_size:
+                    return name, None
+                with profiling.stage('hash', name, object_entry.data_size):
+                    return name, hashlib.blake2b(view[object_entry.data_offset:object_entry.data_offset + object_entry.data_size], digest_size=16).hexdigest()
+
+            try:
+                if jobs > 1:
+                    with futures.ThreadPoolExecutor(max_workers=jobs) as exe:
+                        return dict(exe.map(_hash, selected))
+                return dict(map(_hash, selected))
+            finally:
+                view.release()
+
+def verify(arc_path, version=None, jobs=1):
+    # Check the tables and hash every payload. The result is also the archive's manifest entry.
+    arc_size = os.path.getsize(arc_path)
+    with open(arc_path, 'rb') as f:
+        with profiling.stage('metadata', arc_path):
+            ambiguous = None
+            if version is None:
+                try:
+                    version = detect_version(f)
+                except ValueError as e:
+                    # No layout is intact, or several are. Report the one that fits best.
+                    checked = {v: check_tables(f, v, arc_size) for v in ARC_OBJECT_ENTRY_TYPES}
+                    version = min(checked, key=lambda v: (checked[v][0] is None, len(checked[v][1]), checked[v][2]))
+                    if len(intact_layouts(f)) > 1:
+                        ambiguous = str(e)
+            metadata, problems, unused = check_tables(f, version, arc_size)
+            if ambiguous is not None:
+                problems.insert(0, ambiguous)
+    result = {'version': version, 'size': arc_size, 'unused': unused, 'problems': problems, 'objects': {}}
+    if metadata is None:
+        return result
+    hashes = hash_payloads(arc_path, metadata, jobs)
+    for type_, object_entry in select_objects(metadata):
+        name = f'{object_entry.name.decode("ascii", "replace")}.{type_}'
+        result['objects'][name] = {'size': object_entry.data_size, 'hash': hashes[name]}
+    return result
+
+def compare_manifest(expected, actual):
+    # Returns (added, removed, changed) object names
+    added = sorted(set(actual['objects']) - set(expected['objects']))
+    removed = sorted(set(expected['objects']) - set(actual['objects']))
+    changed = sorted(name for name in set(expected['objects']) & set(actual['objects']) if expected['objects'][name] != actual['objects'][name])
+    return added, removed, changed
+
+def load_manifest(path):
+    with open(path, 'r') as f:
+        manifest = json.load(f)
+    if manifest.get('version') != MANIFEST_VERSION:
+        raise ValueError(f'Unsupported manifest version {manifest.get("version")}.')
+    return manifest['archives']
+
+def save_manifest(path, archives):
+    # Problems and unused space describe this particular build and are not part of the manifest
+    archives = {name: {key: value for key, value in result.items() if key not in ('problems', 'unused')} for name, result in archives.items()}
+    with open(path, 'w') as f:
+        json.dump({'version': MANIFEST_VERSION, 'archives': archives}, f, indent=1, sort_keys=True)
+
+def expand_archives(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            yield from sorted(os.path.join(path, f) for f in os.listdir(path) if f.lower().endswith('.arc'))
+        else:
+            yield path
+
+def verify_archives(arc_paths, version=None, jobs=1, manifest=None):
+    # Prints a report and returns (results by archive name, number of archives with problems or differences)
+    start = time.perf_counter()
+    results = OrderedDict()
+    failed = 0
+    total = 0
+    for arc_path in expand_archives(arc_paths):
+        name = os.path.basename(arc_path)
+        try:
+            result = results[name] = verify(arc_path, version, jobs)
+        except OSError as e:
+            print(f'** {arc_path}: {e}')
+            failed += 1
+            continue
+        total += result['size']
+        status = 'OK' if len(result['problems']) == 0 else f'{len(result["problems"])} problem(s)'
+        print(f'{arc_path}: V{result["version"]}, {len(result["objects"])} objects, {status}' + (f', {result["unused"]} unused bytes' if result['unused'] != 0 else ''))
+        for problem in result['problems']:
+            print(f'** {problem}')
+        differences = 0
+        if manifest is not None:
+            expected = manifest.get(name)
+            if expected is None:
+                print('** Not in manifest.')
+                differences += 1
+            else:
+                added, removed, changed = compare_manifest(expected, result)
+                differences += len(added) + len(removed) + len(changed)
+                for prefix, names in (('+', added), ('-', removed), ('~', changed)):
+                    for object_name in names:
+                        print(f'{prefix} {object_name}')
+                if differences != 0:
+                    print(f'** {len(added)} added, {len(removed)} removed, {len(changed)} changed compared to manifest.')
+        if len(result['problems']) != 0 or differences != 0:
+            failed += 1
+    if manifest is not None:
+        for name in manifest:
+            if name not in results:
+                print(f'{name}: in manifest but not verified.')
+    elapsed = time.perf_counter() - start
+    print(f'Verified {len(results)} archive(s), {total / 1048576:.1f} MiB in {elapsed:.2f}s ({total / 1048576 / elapsed if elapsed > 0 else 0:.1f} MiB/s).')
+    return results, failed
 
 def parse_args():
     p = argparse.ArgumentParser()
     p.add_argument('input_path', help='Path to input.')
-    p.add_argument('output_path', help='Path to output.')
+    p.add_argument('output_path', nargs='*', help='Path to output (or files to add/replace when updating, or more archives when verifying).')
     p.add_argument('-c', '--create', action='store_true', help='Create archive.')
     p.add_argument('-x', '--extract', action='store_true', help='Extract archive.')
-    p.add_argument('-v', '--version', type=int, default=1, help='Specify version (default to 1).')
+    p.add_argument('-u', '--update', action='store_true', help='Add or replace files in an existing archive in place.')
+    p.add_argument('-V', '--verify', action='store_true', help='Check the tables of archives (or directories of archives) and hash their payloads.')
+    p.add_argument('-m', '--manifest', help='Compare verified archives against this manifest and report added, removed and changed objects.')
+    p.add_argument('--save-manifest', metavar='MANIFEST', help='Write object sizes and hashes of verified archives to this manifest.')
+    p.add_argument('-v', '--version', type=int, help='Specify version (default to auto-detect, or 1 when creating).')
+    p.add_argument('-j', '--jobs', type=int, help='Number of parallel writers when extracting, stat workers when creating or hash workers when verifying (default to 1, or # of CPUs when verifying).')
+    p.add_argument('-P', '--progress', action='store_true', help='Report progress and throughput when creating archive.')
+    p.add_argument('--only', action='append', metavar='TYPE', help='Only extract objects of this type (e.g. WIP). Multiple possible.')
+    p.add_argument('--include', action='append', metavar='GLOB', help='Only extract objects whose name matches this case-insensitive pattern (e.g. \'CG*\'). Multiple possible.')
+    p.add_argument('--profile', metavar='REPORT', help='Record time spent per object and stage and write a report (.json or .csv).')
     args = p.parse_args()
-    if args.create and args.extract:
+    operations = sum((args.create, args.extract, args.update, args.verify))
+    if operations > 1:
         p.error('Ambiguous operation.')
-    elif not args.create and not args.extract:
+    elif operations == 0:
         p.error('No operation specified.')
+    elif (args.create or args.extract) and len(args.output_path) != 1:
+        p.error('Exactly one output path is required.')
+    elif args.update and len(args.output_path) == 0:
+        p.error('No files to add or replace.')
+    elif not args.verify and (args.manifest is not None or args.save_manifest is not None):
+        p.error('Manifests can only be used when verifying.')
+    if args.jobs is None:
+        args.jobs = (os.cpu_count() or 1) if args.verify else 1
     return p, args
 
 if __name__ == '__main__':
     p, args = parse_args()
+    if args.profile is not None:
+        profiling.enable()
+    failed = 0
     if args.create:
-        pack(args.input_path, args.output_path, args.version)
+        pack(args.input_path, args.output_path[0], args.version or 1, args.jobs, args.progress)
     elif args.extract:
-        unpack(args.input_path, args.output_path, args.version)
+        unpack(args.input_path, args.output_path[0], args.version, args.only, args.include, args.jobs)
+    elif args.update:
+        update(args.input_path, args.output_path, args.version)
+    elif args.verify:
+        manifest = load_manifest(args.manifest) if args.manifest is not None else None
+        results, failed = verify_archives([args.input_path] + args.output_path, args.version, args.jobs, manifest)
+        if args.save_manifest is not None:
+            save_manifest(args.save_manifest, results)
+    if args.profile is not None:
+        profiling.write_report(args.profile)
+    if failed != 0:
+        sys.exit(1)
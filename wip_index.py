@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+
+# Header-only inventory of WIP/MSK files in directories and ARC archives, kept in a SQLite database.
+# Only the file header and object headers are read (they precede all palettes and payloads), so whole games
+# can be scanned quickly and queried (bit-depth, object count, dimensions, mask pairing) without decoding anything.
+
+import argparse
+import ctypes
+import hashlib
+import os
+import sqlite3
+import sys
+
+import wipf
+import will_arc
+
+
+SCHEMA_VERSION = 2
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS containers (
+    path TEXT PRIMARY KEY,
+    -- Number of indexed files and the newest one's mtime for directories
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    -- Names, sizes and mtimes of the files in a directory
+    files_hash TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    container TEXT NOT NULL REFERENCES containers(path) ON DELETE CASCADE,
+    path TEXT NOT NULL UNIQUE,
+    archive TEXT NOT NULL,
+    name TEXT NOT NULL,
+    type TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    depth INTEGER,
+    objects INTEGER,
+    -- Bounding box of all objects, as drawn by wipf.py --flatten
+    width INTEGER,
+    height INTEGER,
+    -- Payloads (and palettes) extend past the end of the file
+    truncated INTEGER NOT NULL DEFAULT 0,
+    -- MSK file next to a WIP (same container and name)
+    mask TEXT,
+    -- Mask has a different number of objects or object dimensions
+    mask_mismatch INTEGER NOT NULL DEFAULT 0,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS files_name ON files(name, type);
+CREATE TABLE IF NOT EXISTS objects (
+    file_id INTEGER NOT NULL REFERENCES files(id) ON DELETE CASCADE,
+    idx INTEGER NOT NULL,
+    width INTEGER NOT NULL,
+    height INTEGER NOT NULL,
+    x INTEGER NOT NULL,
+    y INTEGER NOT NULL,
+    layer INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    PRIMARY KEY (file_id, idx)
+);
+'''
+
+INDEXED_TYPES = ('WIP', 'MSK')
+
+
+def parse_args():
+    p = argparse.ArgumentParser(usage=(
+        '%(prog)s <Index> [Path]...\n'
+        '       %(prog)s <Index> -q [filters]'
+    ))
+    p.add_argument('index', help='SQLite index file.')
+    p.add_argument('paths', nargs='*', help='Directories (searched recursively, including ARC archives in them) or ARC archives to scan. Unchanged ones are skipped.')
+    p.add_argument('-q', '--query', action='store_true', help='List indexed files matching the filters.')
+    p.add_argument('--prune', action='store_true', help='Drop directories and archives that no longer exist from the index.')
+    p.add_argument('-d', '--depth', type=int, choices=(8, 24), help='Only files with this bit-depth.')
+    p.add_argument('-t', '--type', choices=INDEXED_TYPES, help='Only files of this type.')
+    p.add_argument('-a', '--archive', help='Only files in this directory or archive (by name, e.g. Chip).')
+    p.add_argument('--min-objects', type=int, help='Only files with at least this many objects.')
+    p.add_argument('--larger-than', metavar='WxH', help='Only files whose width or height exceeds this size (e.g. 1280x720).')
+    p.add_argument('--masked', action='store_true', help='Only WIP files with a mask.')
+    p.add_argument('--unmasked', action='store_true', help='Only WIP files without a mask.')
+    p.add_argument('--problems', action='store_true', help='Only unreadable or truncated files and mismatching masks.')
+    p.add_argument('--count', action='store_true', help='Print the number of matches only.')
+    args = p.parse_args()
+    if args.masked and args.unmasked:
+        p.error('--masked and --unmasked are mutually exclusive.')
+    if not args.query and any(getattr(args, name) for name in ('depth', 'type', 'archive', 'min_objects', 'larger_than', 'masked', 'unmasked', 'problems', 'count')):
+        p.error('Filters require --query.')
+    return p, args
+
+def connect(path):
+    db = sqlite3.connect(path)
+    db.row_factory = sqlite3.Row
+    db.execute('PRAGMA foreign_keys = ON')
+    version = db.execute('PRAGMA user_version').fetchone()[0]
+    if version != SCHEMA_VERSION:
+        # Index is only a cache of the headers, rebuild it from scratch
+        db.executescript('DROP TABLE IF EXISTS objects; DROP TABLE IF EXISTS files; DROP TABLE IF EXISTS containers;')
+        db.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+    db.executescript(SCHEMA)
+    return db
+
+def payload_size(header, object_headers):
+    # Bytes following the object headers: palettes (8-bit only) and compressed objects
+    palette_size = 256 * 4 if header.depth == 8 else 0
+    return sum(palette_size + objhdr.size for objhdr in object_headers)
+
+def read_entry(f, size):
+    header, object_headers = wipf.read_header(f)
+    left = min((objhdr.position.x for objhdr in object_headers), default=0)
+    top = min((objhdr.position.y for objhdr in object_headers), default=0)
+    right = max((objhdr.position.x + objhdr.dimension.x for objhdr in object_headers), default=0)
+    bottom = max((objhdr.position.y + objhdr.dimension.y for objhdr in object_headers), default=0)
+    headers_size = ctypes.sizeof(header) + ctypes.sizeof(wipf.WIPFObjectHeader) * len(object_headers)
+    return {
+        'depth': header.depth,
+        'objects': header.objects,
+        'width': right - left,
+        'height': bottom - top,
+        'truncated': headers_size + payload_size(header, object_headers) > size,
+        'object_headers': object_headers,
+    }
+
+def scan_directory(path):
+    # Loose files in the directory and its subdirectories. ARC archives are scanned as containers of their own.
+    entries = []
+    archives = []
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for f in sorted(files):
+            full_path = os.path.join(root, f)
+            suffix = f.rpartition('.')[2].upper()
+            if suffix == 'ARC':
+                archives.append(full_path)
+            elif suffix in INDEXED_TYPES:
+                with open(full_path, 'rb') as wip:
+                    size = os.fstat(wip.fileno()).st_size
+                    entries.append(_scan_entry(full_path, suffix, size, wip))
+    return entries, archives
+
+def scan_archive(path):
+    entries = []
+    with will_arc.ArcArchive(path) as arc:
+        for type_, name in arc:
+            if type_ not in INDEXED_TYPES:
+                continue
+            view = arc[type_, name]
+            with will_arc.ArcObjectReader(view) as f:
+                entries.append(_scan_entry(os.path.join(path, f'{name}.{type_}'), type_, len(view), f))
+    return entries
+
+def _scan_entry(path, type_, size, f):
+    basename = os.path.basename(path)
+    entry = {
+        'path': path,
+        'archive': wipf.archive_name(path),
+        'name': basename.rpartition('.')[0].upper(),
+        'type': type_,
+        'size': size,
+        'error': None,
+    }
+    try:
+        entry.update(read_entry(f, size))
+    except Exception as e:
+        entry['error'] = f'{type(e).__name__}: {e}'
+    return entry
+
+def pair_masks(entries):
+    masks = {entry['name']: entry for entry in entries if entry['type'] == 'MSK'}
+    for entry in entries:
+        if entry['type'] != 'WIP':
+            continue
+        mask = masks.get(entry['name'])
+        entry['mask'] = mask['path'] if mask is not None else None
+        entry['mask_mismatch'] = mask is not None and (mask['error'] is not None or entry['error'] is not None or [
+            (objhdr.dimension.x, objhdr.dimension.y) for objhdr in entry['object_headers']
+        ] != [(objhdr.dimension.x, objhdr.dimension.y) for objhdr in mask['object_headers']])
+
+def _container_signature(path):
+    # (size, mtime_ns, files_hash). Directories use their number of indexed files and the newest one instead of their own
+    # stat, which changes with every unrelated file (including this index) but misses changes in subdirectories.
+    if not os.path.isdir(path):
+        st = os.stat(path)
+        return st.st_size, st.st_mtime_ns, ''
+    count = 0
+    mtime_ns = 0
+    h = hashlib.blake2b(digest_size=16)
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for f in sorted(files):
+            if f.rpartition('.')[2].upper() in INDEXED_TYPES:
+                file_st = os.stat(os.path.join(root, f))
+                count += 1
+                mtime_ns = max(mtime_ns, file_st.st_mtime_ns)
+                h.update(f'{os.path.relpath(os.path.join(root, f), path)}\0{file_st.st_size}\0{file_st.st_mtime_ns}\n'.encode('utf-8', 'surrogateescape'))
+    return count, mtime_ns, h.hexdigest()
+
+def _store(db, container, signature, entries):
+    db.execute('DELETE FROM containers WHERE path = ?', (container,))
+    db.execute('INSERT INTO containers (path, size, mtime_ns, files_hash) VALUES (?, ?, ?, ?)', (container, *signature))
+    for entry in entries:
+        # The file may have been indexed before as part of an enclosing directory
+        db.execute('DELETE FROM files WHERE path = ?', (entry['path'],))
+        cursor = db.execute(
+            'INSERT INTO files (container, path, archive, name, type, size, depth, objects, width, height, truncated, mask, mask_mismatch, error) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (container, entry['path'], entry['archive'], entry['name'], entry['type'], entry['size'], entry.get('depth'), entry.get('objects'),
+             entry.get('width'), entry.get('height'), entry.get('truncated', False), entry.get('mask'), entry.get('mask_mismatch', False), entry['error']),
+        )
+        db.executemany(
+            'INSERT INTO objects (file_id, idx, width, height, x, y, layer, size) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            ((cursor.lastrowid, i, objhdr.dimension.x, objhdr.dimension.y, objhdr.position.x, objhdr.position.y, objhdr.unk, objhdr.size)
+             for i, objhdr in enumerate(entry.get('object_headers', ()))),
+        )
+
+def _scan_container(db, container, force=False):
+    # Returns (number of files indexed or None when unchanged, archives found in a directory)
+    signature = _container_signature(container)
+    row = db.execute('SELECT size, mtime_ns, files_hash FROM containers WHERE path = ?', (container,)).fetchone()
+    unchanged = not force and row is not None and tuple(row) == signature
+    if os.path.isdir(container):
+        if unchanged:
+            archives = [os.path.join(root, f) for root, _, files in os.walk(container) for f in files if f.lower().endswith('.arc')]
+            return None, sorted(archives)
+        entries, archives = scan_directory(container)
+    else:
+        if unchanged:
+            return None, []
+        entries, archives = scan_archive(container), []
+    # Masks are only paired within the same directory or archive
+    by_directory = {}
+    for entry in entries:
+        by_directory.setdefault(os.path.dirname(entry['path']), []).append(entry)
+    for group in by_directory.values():
+        pair_masks(group)
+    _store(db, container, signature, entries)
+    return len(entries), archives
+
+def scan(db, paths, force=False):
+    # Yields (container, number of files indexed or None when unchanged, error)
+    pending = [os.path.abspath(path) for path in paths]
+    with db:
+        while len(pending) != 0:
+            container = pending.pop(0)
+            try:
+                count, archives = _scan_container(db, container, force)
+            except Exception as e:
+                yield container, None, f'{type(e).__name__}: {e}'
+                continue
+            pending.extend(archives)
+            yield container, count, None
+
+def prune(db):
+    removed = [row['path'] for row in db.execute('SELECT path FROM containers') if not os.path.exists(row['path'])]
+    with db:
+        db.executemany('DELETE FROM containers WHERE path = ?', ((path,) for path in removed))
+    return removed
+
+def query(db, depth=None, type_=None, archive=None, min_objects=None, larger_than=None, masked=None, problems=False):
+    conditions = []
+    params = []
+    if depth is not None:
+        conditions.append('depth = ?')
+        params.append(depth)
+    if type_ is not None:
+        conditions.append('type = ?')
+        params.append(type_.upper())
+    if archive is not None:
+        conditions.append('archive = ? COLLATE NOCASE')
+        params.append(archive)
+    if min_objects is not None:
+        conditions.append('objects >= ?')
+        params.append(min_objects)
+    if larger_than is not None:
+        conditions.append('(width > ? OR height > ?)')
+        params.extend(larger_than)
+    if masked is not None:
+        conditions.append("type = 'WIP' AND mask IS NOT NULL" if masked else "type = 'WIP' AND mask IS NULL")
+    if problems:
+        conditions.append('(error IS NOT NULL OR truncated OR mask_mismatch)')
+    where = f'WHERE {" AND ".join(conditions)}' if len(conditions) != 0 else ''
+    return db.execute(f'SELECT * FROM files {where} ORDER BY path', params).fetchall()
+
+def object_headers(db, path):
+    return db.execute('SELECT * FROM objects WHERE file_id = (SELECT id FROM files WHERE path = ?) ORDER BY idx', (os.path.abspath(path),)).fetchall()
+
+def format_row(row):
+    if row['error'] is not None:
+        return f'{row["path"]}: {row["error"]}'
+    notes = []
+    if row['mask'] is not None:
+        notes.append('masked' if not row['mask_mismatch'] else 'mask mismatch')
+    if row['truncated']:
+        notes.append('truncated')
+    notes = f' ({", ".join(notes)})' if len(notes) != 0 else ''
+    return f'{row["path"]}: {row["depth"]}-bit, {row["objects"]} object(s), {row["width"]}x{row["height"]}{notes}'
+
+if __name__ == '__main__':
+    p, args = parse_args()
+    db = connect(args.index)
+    if args.prune:
+        for path in prune(db):
+            print(f'Pruned {path}')
+    failed = 0
+    for container, count, error in scan(db, args.paths):
+        if error is not None:
+            failed += 1
+            print(f'** {container}: {error}')
+        else:
+            print(f'{container}: {"unchanged" if count is None else f"{count} file(s)"}')
+    if args.query:
+        larger_than = None
+        if args.larger_than is not None:
+            width, _, height = args.larger_than.lower().partition('x')
+            larger_than = (int(width), int(height))
+        masked = True if args.masked else False if args.unmasked else None
+        rows = query(db, args.depth, args.type, args.archive, args.min_objects, larger_than, masked, args.problems)
+        if args.count:
+            print(len(rows))
+        else:
+            for row in rows:
+                print(format_row(row))
+    elif len(args.paths) == 0 and not args.prune:
+        p.error('Nothing to do. Give paths to scan or --query.')
+    db.close()
+    if failed != 0:
+        sys.exit(1)
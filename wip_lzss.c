@@ -0,0 +1,99 @@
+/*
+ * Native WIP LZSS decoder for wipf.py (optional).
+ * Mirrors _lzss_calcsize/_lzss_decompress in wipf.py. wipf.py picks it up automatically when built next to it:
+ *
+ *     cc -O2 -shared -fPIC -o wip_lzss.so wip_lzss.c
+ */
+
+#include <stddef.h>
+#include <stdint.h>
+
+#if defined(_WIN32)
+#define EXPORT __declspec(dllexport)
+typedef intptr_t ssize_t;
+#else
+#define EXPORT
+#include <sys/types.h>
+#endif
+
+#define LZSS_WINDOW_SIZE 4096
+#define LZSS_ERR_TRUNCATED -1
+#define LZSS_ERR_OVERFLOW -2
+
+EXPORT ssize_t wip_lzss_calcsize(const uint8_t *blk, size_t blk_len) {
+    size_t ptr = 0;
+    ssize_t size = 0;
+    for (;;) {
+        if (ptr >= blk_len) {
+            return LZSS_ERR_TRUNCATED;
+        }
+        uint8_t flag = blk[ptr++];
+        for (int i = 0; i < 8; i++, flag >>= 1) {
+            if (flag & 1) {
+                if (ptr >= blk_len) {
+                    return LZSS_ERR_TRUNCATED;
+                }
+                size++;
+                ptr++;
+            } else {
+                if (ptr + 1 >= blk_len) {
+                    return LZSS_ERR_TRUNCATED;
+                }
+                /* Detect EOS */
+                if (blk[ptr] == 0 && blk[ptr + 1] == 0) {
+                    return size;
+                }
+                /* Lowest nibble of the lookback is the length. */
+                size += (blk[ptr + 1] & 0xf) + 2;
+                ptr += 2;
+            }
+        }
+    }
+}
+
+EXPORT ssize_t wip_lzss_decompress(const uint8_t *blk, size_t blk_len, uint8_t *out, size_t out_len) {
+    size_t ptr = 0;
+    size_t outptr = 0;
+    for (;;) {
+        if (ptr >= blk_len) {
+            return LZSS_ERR_TRUNCATED;
+        }
+        uint8_t flag = blk[ptr++];
+        for (int i = 0; i < 8; i++, flag >>= 1) {
+            if (flag & 1) {
+                /* Literal */
+                if (ptr >= blk_len) {
+                    return LZSS_ERR_TRUNCATED;
+                }
+                if (outptr >= out_len) {
+                    return LZSS_ERR_OVERFLOW;
+                }
+                out[outptr++] = blk[ptr++];
+            } else {
+                /* Lookback */
+                if (ptr + 1 >= blk_len) {
+                    return LZSS_ERR_TRUNCATED;
+                }
+                unsigned inst = ((unsigned) blk[ptr] << 8) | blk[ptr + 1];
+                ptr += 2;
+                /* Detect EOS */
+                if (inst == 0) {
+                    return (ssize_t) outptr;
+                }
+                size_t look_back_index = (inst >> 4) & 0xfff;
+                size_t look_back_len = (inst & 0xf) + 2;
+                if (outptr + look_back_len > out_len) {
+                    return LZSS_ERR_OVERFLOW;
+                }
+                /* Window position i holds the latest output byte o with (o + 1) % 4096 == i (see wipf.py). */
+                size_t distance = (outptr + 1 + LZSS_WINDOW_SIZE - look_back_index) % LZSS_WINDOW_SIZE;
+                if (distance == 0) {
+                    distance = LZSS_WINDOW_SIZE;
+                }
+                for (size_t j = 0; j < look_back_len; j++, outptr++) {
+                    out[outptr] = outptr >= distance ? out[outptr - distance] : 0;
+                }
+            }
+        }
+    }
+}
@@ -1,31 +1,41 @@
 #!/usr/bin/env python3
 
-# WillPlus Image Pack (WIP) reader
+# WillPlus Image Pack (WIP) reader and writer
 # The format is used by older (200x era) WillPlus VN engine.
 # Special thanks to: asmodean's exbelarc (http://asmodean.reverse.net/pages/exbelarc.html).
 # Although the source release is incomplete and didn't compile, it provides all the information necessary for me to write my own (and improved) parser.
 
 import argparse
+import collections
+import contextlib
 import ctypes
-import fnmatch
-import io
+import functools
+import glob
+import hashlib
 import itertools
 import os
 import posixpath
-import re
 import string
+import sys
+import threading
 import warnings
+from concurrent import futures
 from PIL import Image
 
+import profiling
+import will_arc
+
 try:
     import numba
 except ImportError:
-    print('Numba not installed. Falling back to Python LZSS implementation.')
     numba = None
 
-WIPF_MAGIC = b'WIPF'
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
-FNMATCH_ESCAPE = re.compile(r'([\*\?\[\]])')
+WIPF_MAGIC = b'WIPF'
 
 class WIPFHeader(ctypes.LittleEndianStructure):
     _pack_ = 1
@@ -52,22 +62,41 @@ class WIPFObjectHeader(ctypes.LittleEndianStructure):
         ('size', ctypes.c_uint32),
     )
 
-def _fnmatch_escape(filename):
-    return FNMATCH_ESCAPE.sub(r'[\1]', filename)
-
 def parse_args():
     p = argparse.ArgumentParser()
-    p.add_argument('wipf', help='Source WIP file.')
-    p.add_argument('-o', '--output', help='Output file (use {index} for inserting indices for multi-object images and {offset} for inserting object offset).')
-    # TODO apply mask and flattern all objects onto one image (good for preview)
-    #p.add_argument('-f', '--flattern', action='store_true', help='Draw all objects on a single image.')
+    p.add_argument('wipf', nargs='+', help='Source WIP file (use path/to/Archive.arc/NAME.WIP for reading directly from an ARC archive). Multiple files, directories, ARC archives or globs are accepted with --batch.')
+    p.add_argument('-o', '--output', help='Output file (use {index} for inserting indices for multi-object images and {offset} for inserting object offset. {name} and {archive} are also available with --batch).')
+    p.add_argument('-b', '--batch', action='store_true', help='Convert many files in one go.')
+    p.add_argument('-j', '--jobs', type=int, default=(os.cpu_count() or 1), help='Number of worker processes for --batch (Defaults to # of CPUs or 1 if cannot be determined).')
+    p.add_argument('-f', '--flatten', action='store_true', help='Draw all objects on a single image.')
     p.add_argument('-m', '--mask', help='Read a mask file and use it as alpha channel.')
     p.add_argument('-M', '--auto-mask', action='store_true', help='Automatically looking for mask file and use it when appropriate.')
     p.add_argument('-r', '--export-metadata-renpy', help='Export object metadata as Ren\'Py ATL.')
     p.add_argument('-c', '--renpy-image-tag', help='Set the tag of the image. Only makes sense when using --export-metadata-renpy.')
     p.add_argument('-p', '--renpy-image-prefix', help='Override the path prefix for image file. Only makes sense when using --export-metadata-renpy.')
     p.add_argument('--webp', action='store_true', help='Save as WebP lossless instead of PNG.')
-    return p, p.parse_args()
+    p.add_argument('-e', '--encode-threads', type=int, default=2, help='Encoder threads per process. Images are decoded while earlier ones are still being encoded (0 disables, defaults to 2).')
+    p.add_argument('--profile', metavar='REPORT', help='Record time spent per file and stage and write a report (.json or .csv).')
+    args = p.parse_args()
+    if not args.batch and len(args.wipf) != 1:
+        p.error('Multiple inputs require --batch.')
+    return p, args
+
+@functools.lru_cache(maxsize=None)
+def open_archive(arc_path):
+    # Archives are kept mapped for the lifetime of the process so object readers can outlive the caller.
+    return will_arc.ArcArchive(arc_path)
+
+def open_file(path):
+    arc_path, member = will_arc.split_arc_path(path)
+    if arc_path is None:
+        return open(path, 'rb')
+    return open_archive(arc_path).open(member)
+
+def listdir(path):
+    if path.lower().endswith('.arc') and os.path.isfile(path):
+        return open_archive(path).filenames()
+    return os.listdir(path if len(path) != 0 else '.')
 
 def dump_info(header, object_headers):
     print(f'Number of Objects: {header.objects}')
@@ -94,79 +123,128 @@ def read_header(wipf):
         raise RuntimeError('Not a valid WIP file.')
     return header, object_headers
 
-def wip_lzss_decompress_numba(compressed):
-    window = bytearray(4096)
-    @numba.njit(cache=True)
-    def _calcsize(blk):
-        size = 0
-        ptr = 0
-        eos = False
-        while not eos:
-            flag = blk[ptr]
-            ptr += 1
-            for _ in range(8):
-                if flag & 1:
-                    size += 1
-                    ptr += 1
-                else:
-                    # Detect EOS
-                    if blk[ptr] == 0 and blk[ptr+1] == 0:
-                        eos = True
-                        break
-                    # Lowest nibble of the lookback is the length.
-                    size += (blk[ptr+1] & 0xf) + 2
-                    ptr += 2
-                flag >>= 1
-        return size
-
-    @numba.njit(cache=True)
-    def _decompress(w, blk, out):
-        ptr = 0
-        outptr = 0
-        wptr = 1
-        eos = False
-        while not eos:
-            flag = blk[ptr]
-            ptr += 1
-            for _ in range(8):
-                # Literal
-                if flag & 1:
-                    out[outptr] = blk[ptr]
-                    w[wptr] = blk[ptr]
-                    ptr += 1
+LZSS_WINDOW_SIZE = 4096
+
+# Error codes returned by the compiled decoder
+LZSS_ERR_TRUNCATED = -1
+LZSS_ERR_OVERFLOW = -2
+
+def _lzss_calcsize(blk):
+    size = 0
+    ptr = 0
+    while True:
+        if ptr >= len(blk):
+            return LZSS_ERR_TRUNCATED
+        flag = blk[ptr]
+        ptr += 1
+        for _ in range(8):
+            if flag & 1:
+                if ptr >= len(blk):
+                    return LZSS_ERR_TRUNCATED
+                size += 1
+                ptr += 1
+            else:
+                if ptr + 1 >= len(blk):
+                    return LZSS_ERR_TRUNCATED
+                # Detect EOS
+                if blk[ptr] == 0 and blk[ptr+1] == 0:
+                    return size
+                # Lowest nibble of the lookback is the length.
+                size += (blk[ptr+1] & 0xf) + 2
+                ptr += 2
+            flag >>= 1
+
+def _lzss_decompress(blk, out):
+    # The window is never materialized. Window position i always holds the
+    # latest output byte o with (o + 1) % 4096 == i (or 0 before anything
+    # was written there), so lookbacks can be served from the output itself.
+    ptr = 0
+    outptr = 0
+    while True:
+        if ptr >= len(blk):
+            return LZSS_ERR_TRUNCATED
+        flag = blk[ptr]
+        ptr += 1
+        for _ in range(8):
+            # Literal
+            if flag & 1:
+                if ptr >= len(blk):
+                    return LZSS_ERR_TRUNCATED
+                if outptr >= len(out):
+                    return LZSS_ERR_OVERFLOW
+                out[outptr] = blk[ptr]
+                ptr += 1
+                outptr += 1
+            # Lookback
+            else:
+                if ptr + 1 >= len(blk):
+                    return LZSS_ERR_TRUNCATED
+                inst = (blk[ptr] << 8) | blk[ptr+1]
+                ptr += 2
+                # Detect EOS
+                if inst == 0:
+                    return outptr
+                # Decode lookback instruction
+                look_back_index, look_back_len = ((inst >> 4) & 0xfff), ((inst & 0xf) + 2)
+                if outptr + look_back_len > len(out):
+                    return LZSS_ERR_OVERFLOW
+                distance = (outptr + 1 - look_back_index) % LZSS_WINDOW_SIZE
+                if distance == 0:
+                    distance = LZSS_WINDOW_SIZE
+                src = outptr - distance
+                for _ in range(look_back_len):
+                    out[outptr] = out[src] if src >= 0 else 0
                     outptr += 1
-                    wptr = (wptr + 1) % len(w)
-                # Lookback
-                else:
-                    inst = (blk[ptr] << 8) | blk[ptr+1]
-                    ptr += 2
-                    # Detect EOS
-                    if inst == 0:
-                        eos = True
-                        break
-                    # Decode lookback instruction
-                    look_back_index, look_back_len = ((inst >> 4) & 0xfff), ((inst & 0xf) + 2)
-                    for _ in range(look_back_len):
-                        # Save lookback result and update everything
-                        byte = w[look_back_index]
-                        out[outptr] = byte
-                        w[wptr] = byte
-                        outptr += 1
-                        wptr = (wptr + 1) % len(w)
-                        look_back_index = (look_back_index + 1) % len(w)
-                flag >>= 1
-
-    decompressed = bytearray(_calcsize(compressed))
-    _decompress(window, compressed, decompressed)
+                    src += 1
+            flag >>= 1
+
+if numba is not None:
+    # Compiled once per process (and cached on disk) instead of on every call
+    _lzss_calcsize_numba = numba.njit(cache=True, nogil=True)(_lzss_calcsize)
+    _lzss_decompress_numba = numba.njit(cache=True, nogil=True)(_lzss_decompress)
+
+def _check_lzss_result(result):
+    if result == LZSS_ERR_TRUNCATED:
+        raise EOFError('Unexpected end-of-stream when decompressing data.')
+    elif result == LZSS_ERR_OVERFLOW:
+        raise ValueError('Decompressed data larger than expected.')
+    return result
+
+def wip_lzss_decompress_numba(compressed, size=None):
+    if size is None:
+        size = _check_lzss_result(_lzss_calcsize_numba(compressed))
+    decompressed = bytearray(size)
+    written = _check_lzss_result(_lzss_decompress_numba(compressed, decompressed))
+    if written != size:
+        del decompressed[written:]
     return decompressed
 
-def wip_lzss_decompress_py(compressed):
-    compressed_io = io.BytesIO(compressed)
-    decompressed = io.BytesIO()
-    window = bytearray(4096)
-    index = 1
-    flags_buf = bytearray(1)
-    eos = False
+def _lzss_flag_ops(flags):
+    # Split a flag byte into literal runs (n > 0) and look-backs (0), LSB first
+    ops = []
+    for _ in range(8):
+        if flags & 1:
+            if ops and ops[-1]:
+                ops[-1] += 1
+            else:
+                ops.append(1)
+        else:
+            ops.append(0)
+        flags >>= 1
+    return tuple(ops)
+
+_LZSS_FLAG_OPS = tuple(_lzss_flag_ops(flags) for flags in range(256))
+
+def wip_lzss_decompress_py(compressed, size=None):
+    blk = bytes(compressed)
+    # No need for a sizing pass here since the output grows as needed
+    if size is None:
+        size = sys.maxsize
+    # Appending to a bytearray turned out faster than slice assignment into a preallocated one in CPython.
+    decompressed = bytearray()
+    flag_ops = _LZSS_FLAG_OPS
+    ptr = 0
+    outptr = 0
 
     # Bitstream format: ffffffff [llllllll|iiiiiiiiiiiidddd]{1-8} ...
     # f: Flag (1: literal, 0: look-back)
@@ -175,77 +253,302 @@ def wip_lzss_decompress_py(compressed):
     # d: Look-back distance/length (with THRESHOLD of 2 so it's evaluated as (raw_distance_bits + 2))
     # The stream seems to terminate with a look-back with i=0 and d=0
     # All data are in big endian byte order
-    while not eos:
-        if compressed_io.readinto(flags_buf) != 1:
-            raise EOFError('Unexpected end-of-stream when decompressing data.')
-        flags = flags_buf[0]
-        for _ in range(8):
-            if flags & 1:
-                # literal
-                byte = compressed_io.read(1)
-                if len(byte) != 1:
-                    raise EOFError('Unexpected end-of-stream when decompressing data.')
-                decompressed.write(byte)
-                window[index] = byte[0]
-                index = (index + 1) % len(window)
-            else:
-                # look-back
-                inst = compressed_io.read(2)
-                if len(inst) != 2:
-                    raise EOFError('Unexpected end-of-stream when decompressing data.')
-                inst = int.from_bytes(inst, 'big')
-                look_back_index, look_back_len = ((inst >> 4) & 0xfff), ((inst & 0xf) + 2)
-                # End-of-stream marker?
-                if look_back_index == 0 and look_back_len == 2:
-                    eos = True
-                    break
-                for _ in range(look_back_len):
-                    byte = window[look_back_index]
-                    decompressed.write(byte.to_bytes(1, 'big'))
-                    window[index] = byte
-                    index = (index + 1) % len(window)
-                    look_back_index = (look_back_index + 1) % len(window)
-            flags >>= 1
-    print(len(decompressed.getvalue()))
-    return decompressed.getvalue()
-
-# Use numba implementation if possible for better performance
-wip_lzss_decompress = wip_lzss_decompress_numba if numba is not None else wip_lzss_decompress_py
-
-def load_wipf(wipf, filename=None, info_only=False):
-    header, object_headers = read_header(wipf)
+    # Look-backs are served from the output buffer (see _lzss_decompress).
+    try:
+        while True:
+            ops = flag_ops[blk[ptr]]
+            ptr += 1
+            for op in ops:
+                if op:
+                    # Run of literals. A short slice at the end of the input fails on the next read.
+                    decompressed += blk[ptr:ptr+op]
+                    ptr += op
+                    outptr += op
+                else:
+                    # look-back
+                    inst = (blk[ptr] << 8) | blk[ptr+1]
+                    ptr += 2
+                    # End-of-stream marker?
+                    if inst == 0:
+                        if len(decompressed) > size:
+                            raise ValueError('Decompressed data larger than expected.')
+                        return decompressed
+                    look_back_len = (inst & 0xf) + 2
+                    distance = ((outptr + 1 - (inst >> 4)) & 0xfff) or LZSS_WINDOW_SIZE
+                    src = outptr - distance
+                    if src >= 0 and distance >= look_back_len:
+                        decompressed += decompressed[src:src+look_back_len]
+                    elif src >= 0:
+                        # Overlapping copy repeats the last `distance` bytes
+                        decompressed += (decompressed[src:] * (look_back_len // distance + 1))[:look_back_len]
+                    else:
+                        # Reaches into the initial (zero-filled) window
+                        for i in range(src, src + look_back_len):
+                            decompressed.append(decompressed[i] if i >= 0 else 0)
+                    outptr += look_back_len
+                    if outptr > size:
+                        raise ValueError('Decompressed data larger than expected.')
+    except IndexError:
+        raise EOFError('Unexpected end-of-stream when decompressing data.') from None
 
-    # Output information
-    if filename is not None:
-        print(f'Filename: {filename}')
-    dump_info(header, object_headers)
+def _load_lzss_library():
+    # Optional native decoder built from wip_lzss.c next to this file
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    for name in ('wip_lzss.so', 'wip_lzss.dylib', 'wip_lzss.dll'):
+        path = os.path.join(script_dir, name)
+        if not os.path.isfile(path):
+            continue
+        try:
+            lib = ctypes.CDLL(path)
+        except OSError:
+            continue
+        lib.wip_lzss_calcsize.argtypes = (ctypes.c_char_p, ctypes.c_size_t)
+        lib.wip_lzss_calcsize.restype = ctypes.c_ssize_t
+        lib.wip_lzss_decompress.argtypes = (ctypes.c_char_p, ctypes.c_size_t, ctypes.c_void_p, ctypes.c_size_t)
+        lib.wip_lzss_decompress.restype = ctypes.c_ssize_t
+        return lib
+    return None
 
-    if info_only:
-        return None
+lzss_library = _load_lzss_library()
 
-    if header.depth not in (8, 24):
-        raise ValueError(f'Cannot infer image mode from unexpected bit-depth {header.depth}')
+def wip_lzss_decompress_native(compressed, size=None):
+    blk = bytes(compressed)
+    if size is None:
+        size = _check_lzss_result(lzss_library.wip_lzss_calcsize(blk, len(blk)))
+    decompressed = bytearray(size)
+    out = (ctypes.c_char * size).from_buffer(decompressed)
+    written = _check_lzss_result(lzss_library.wip_lzss_decompress(blk, len(blk), out, size))
+    del out
+    if written != size:
+        del decompressed[written:]
+    return decompressed
 
-    result = {'header': header, 'object_headers': [], 'objects': []}
-    for objhdr in object_headers:
-        result['object_headers'].append(objhdr)
+# Use native or numba implementation if possible for better performance
+if lzss_library is not None:
+    wip_lzss_decompress = wip_lzss_decompress_native
+elif numba is not None:
+    wip_lzss_decompress = wip_lzss_decompress_numba
+else:
+    print('Numba not installed. Falling back to Python LZSS implementation.')
+    wip_lzss_decompress = wip_lzss_decompress_py
+
+LZSS_MAX_MATCH = 17
+# Match candidates examined per position. Higher compresses slightly better but slower.
+LZSS_MAX_CHAIN = 64
+
+def _lzss_compress(data, out, head, prev, max_chain):
+    # Greedy LZSS with hash chains keyed on the next 2 bytes (exact, so every candidate matches at least 2 bytes).
+    # head maps a key to its latest position, prev maps a position (mod window size) to the previous one with the same key.
+    # out must hold at least len(data) + len(data) // 8 + 4 bytes.
+    n = len(data)
+    pos = 0
+    outptr = 0
+    flag_ptr = 0
+    flag_bit = 8
+    while pos < n:
+        if flag_bit == 8:
+            flag_ptr = outptr
+            out[outptr] = 0
+            outptr += 1
+            flag_bit = 0
+        best_len = 0
+        best_pos = 0
+        if pos + 1 < n:
+            limit = min(LZSS_MAX_MATCH, n - pos)
+            cand = head[(data[pos] << 8) | data[pos+1]]
+            chain = max_chain
+            while cand >= 0 and pos - cand <= LZSS_WINDOW_SIZE and chain > 0:
+                length = 2
+                while length < limit and data[cand+length] == data[pos+length]:
+                    length += 1
+                # Index 0 with length 2 would be read as end-of-stream
+                if length > best_len and not (length == 2 and ((cand + 1) & 0xfff) == 0):
+                    best_len = length
+                    best_pos = cand
+                    if length == limit:
+                        break
+                cand = prev[cand & 0xfff]
+                chain -= 1
+        if best_len >= 2:
+            # Window position of output byte o is (o + 1) % 4096 (see _lzss_decompress)
+            inst = (((best_pos + 1) & 0xfff) << 4) | (best_len - 2)
+            out[outptr] = inst >> 8
+            out[outptr+1] = inst & 0xff
+            outptr += 2
+        else:
+            best_len = 1
+            out[flag_ptr] |= 1 << flag_bit
+            out[outptr] = data[pos]
+            outptr += 1
+        flag_bit += 1
+        # Index every position covered by this item
+        for p in range(pos, min(pos + best_len, n - 1)):
+            key = (data[p] << 8) | data[p+1]
+            prev[p & 0xfff] = head[key]
+            head[key] = p
+        pos += best_len
+    # End-of-stream look-back
+    if flag_bit == 8:
+        out[outptr] = 0
+        outptr += 1
+    out[outptr] = 0
+    out[outptr+1] = 0
+    return outptr + 2
+
+if numba is not None:
+    _lzss_compress_numba = numba.njit(cache=True, nogil=True)(_lzss_compress)
+
+def _lzss_compress_bound(size):
+    return size + size // 8 + 4
+
+def wip_lzss_compress_numba(data, max_chain=LZSS_MAX_CHAIN):
+    src = numpy.frombuffer(data, numpy.uint8)
+    out = numpy.empty(_lzss_compress_bound(len(src)), numpy.uint8)
+    head = numpy.full(0x10000, -1, numpy.int64)
+    prev = numpy.full(LZSS_WINDOW_SIZE, -1, numpy.int64)
+    written = _lzss_compress_numba(src, out, head, prev, max_chain)
+    return out[:written].tobytes()
+
+def wip_lzss_compress_py(data, max_chain=LZSS_MAX_CHAIN):
+    src = bytes(data)
+    out = bytearray(_lzss_compress_bound(len(src)))
+    written = _lzss_compress(src, out, [-1] * 0x10000, [-1] * LZSS_WINDOW_SIZE, max_chain)
+    del out[written:]
+    return bytes(out)
+
+# Numba implies numpy
+if numba is not None:
+    wip_lzss_compress = wip_lzss_compress_numba
+else:
+    wip_lzss_compress = wip_lzss_compress_py
+
+def _decode_object_pil(header, objhdr, decompressed_buffer, palette):
+    mv = memoryview(decompressed_buffer)
+    pixels = objhdr.dimension.x * objhdr.dimension.y
+    if header.depth == 24: # RGB
+        channels = tuple(Image.frombuffer('L', (objhdr.dimension.x, objhdr.dimension.y), mv[pixels*i:pixels*(i+1)], 'raw', 'L', 0, 1) for i in reversed(range(3)))
+        return Image.merge('RGB', channels)
+    elif header.depth == 8: # P
+        image = Image.frombuffer('P', (objhdr.dimension.x, objhdr.dimension.y), mv, 'raw', 'P', 0, 1)
+        image.putpalette(palette, 'RGBX')
+        return image
+
+def _decode_object_numpy(header, objhdr, decompressed_buffer, palette, alpha=None):
+    width, height = objhdr.dimension.x, objhdr.dimension.y
+    pixels = numpy.frombuffer(decompressed_buffer, numpy.uint8)
+    if alpha is not None and alpha.shape != (height, width):
+        raise ValueError(f'Mask object size {alpha.shape[1]}x{alpha.shape[0]} does not match image object size {width}x{height}.')
+    if header.depth == 24: # RGB
+        # Planes are stored as B, G, R. Interleave them into RGB(A) with one strided copy.
+        out = numpy.empty((height, width, 3 if alpha is None else 4), numpy.uint8)
+        out[..., :3] = pixels.reshape(3, height, width)[::-1].transpose(1, 2, 0)
+    elif header.depth == 8: # P
+        if alpha is None:
+            return _decode_object_pil(header, objhdr, decompressed_buffer, palette)
+        out = numpy.frombuffer(palette, numpy.uint8).reshape(256, 4)[pixels.reshape(height, width)]
+    if alpha is not None:
+        out[..., 3] = alpha
+    return Image.fromarray(out)
+
+def _mask_alpha(mask_object):
+    header, objhdr = mask_object['header'], mask_object['object_header']
+    width, height = objhdr.dimension.x, objhdr.dimension.y
+    pixels = numpy.frombuffer(mask_object['buffer'], numpy.uint8)
+    # Same luma weights as PIL's convert('L')
+    if header.depth == 8:
+        palette = numpy.frombuffer(mask_object['palette'], numpy.uint8).reshape(256, 4).astype(numpy.uint32)
+        lut = ((palette[:, 0] * 19595 + palette[:, 1] * 38470 + palette[:, 2] * 7471 + 0x8000) >> 16).astype(numpy.uint8)
+        return lut[pixels.reshape(height, width)]
+    else:
+        planes = pixels.reshape(3, height, width).astype(numpy.uint32)
+        return ((planes[2] * 19595 + planes[1] * 38470 + planes[0] * 7471 + 0x8000) >> 16).astype(numpy.uint8)
+
+def _decode_object(header, objhdr, decompressed_buffer, palette, mask_object=None, filename=None):
+    pixels = objhdr.dimension.x * objhdr.dimension.y
+    expected_bytes = len(decompressed_buffer)
+    if numpy is not None:
+        alpha = None
+        if mask_object is not None:
+            with profiling.stage('mask', filename, pixels):
+                alpha = _mask_alpha(mask_object)
+        with profiling.stage('decode', filename, expected_bytes):
+            return _decode_object_numpy(header, objhdr, decompressed_buffer, palette, alpha)
+    with profiling.stage('decode', filename, expected_bytes):
+        image = _decode_object_pil(header, objhdr, decompressed_buffer, palette)
+    if mask_object is not None:
+        with profiling.stage('mask', filename, pixels):
+            image.putalpha(_decode_object_pil(mask_object['header'], mask_object['object_header'], mask_object['buffer'], mask_object['palette']).convert('L'))
+    return image
+
+def _iter_objects(wipf, header, object_headers, filename, mask_objects, raw):
+    for index, objhdr in enumerate(object_headers):
         if header.depth == 8:
             # RGBX?
             palette = wipf.read(256 * 4)
         else:
             palette = None
-        decompressed_buffer = wip_lzss_decompress(wipf.read(objhdr.size))
-        mv = memoryview(decompressed_buffer)
-        pixels = objhdr.dimension.x * objhdr.dimension.y
-        expected_bytes = pixels * (header.depth // 8)
+        expected_bytes = objhdr.dimension.x * objhdr.dimension.y * (header.depth // 8)
+        with profiling.stage('read', filename, objhdr.size):
+            compressed = wipf.read(objhdr.size)
+        with profiling.stage('decompress', filename, expected_bytes):
+            decompressed_buffer = wip_lzss_decompress(compressed, expected_bytes)
+        del compressed
         assert expected_bytes == len(decompressed_buffer), f'Unexpected size of decompressed object (expecting {expected_bytes}, got {len(decompressed_buffer)})'
-        if header.depth == 24: # RGB
-            channels = tuple(Image.frombuffer('L', (objhdr.dimension.x, objhdr.dimension.y), mv[pixels*i:pixels*(i+1)], 'raw', 'L', 0, 1) for i in reversed(range(3)))
-            result['objects'].append(Image.merge('RGB', channels))
-        elif header.depth == 8: # P
-            image = Image.frombuffer('P', (objhdr.dimension.x, objhdr.dimension.y), mv, 'raw', 'P', 0, 1)
-            image.putpalette(palette, 'RGBX')
-            result['objects'].append(image)
+        # The matching mask object is read in step with this one
+        mask_object = next(mask_objects) if mask_objects is not None else None
+        wip_object = {'index': index, 'header': header, 'object_header': objhdr, 'buffer': decompressed_buffer, 'palette': palette, 'image': None}
+        # Raw mode only keeps the decompressed buffers (e.g. for masks that will be fused into another image).
+        if not raw:
+            wip_object['image'] = _decode_object(header, objhdr, decompressed_buffer, palette, mask_object, filename)
+        del decompressed_buffer, mask_object
+        yield wip_object
+        # Don't hold on to the object while the next one is decoded
+        del wip_object
+
+def stream_wipf(wipf, filename=None, mask=None, raw=False, verbose=True):
+    # Returns (header, object_headers, objects) where objects decodes one object at a time (dicts with index, header,
+    # object_header, buffer, palette and image), so callers can save and drop each one before the next is read.
+    # mask is the stream_wipf(..., raw=True) result of the mask file. wipf (and the mask file) must stay open while iterating.
+    header, object_headers = read_header(wipf)
+
+    # Output information
+    if verbose:
+        if filename is not None:
+            print(f'Filename: {filename}')
+        dump_info(header, object_headers)
+
+    if header.depth not in (8, 24):
+        raise ValueError(f'Cannot infer image mode from unexpected bit-depth {header.depth}')
+
+    if mask is not None and len(mask[1]) != len(object_headers):
+        raise ValueError('WIPF and mask contain diffeent numbers of entries.')
+
+    return header, object_headers, _iter_objects(wipf, header, object_headers, filename, mask[2] if mask is not None else None, raw)
+
+def _loaded_stream(result):
+    # stream_wipf() view of a raw load_wipf() result
+    objects = ({'index': index, 'header': result['header'], 'object_header': objhdr, 'buffer': buffer, 'palette': palette, 'image': None}
+               for index, (objhdr, buffer, palette) in enumerate(zip(result['object_headers'], result['buffers'], result['palettes'])))
+    return result['header'], result['object_headers'], objects
+
+def load_wipf(wipf, filename=None, info_only=False, mask=None, raw=False, verbose=True):
+    # Keeps all objects in memory. mask is a raw load_wipf() result. See stream_wipf() for decoding one object at a time.
+    if info_only:
+        header, object_headers = read_header(wipf)
+        if filename is not None:
+            print(f'Filename: {filename}')
+        dump_info(header, object_headers)
+        return None
+
+    header, object_headers, objects = stream_wipf(wipf, filename, _loaded_stream(mask) if mask is not None else None, raw, verbose)
+    result = {'header': header, 'object_headers': list(object_headers), 'objects': [], 'buffers': [], 'palettes': []}
+    for wip_object in objects:
+        # Decoded images don't need their buffers any more
+        if raw:
+            result['buffers'].append(wip_object['buffer'])
+            result['palettes'].append(wip_object['palette'])
+        else:
+            result['objects'].append(wip_object['image'])
     return result
 
 def apply_mask(wipf, mask):
@@ -256,83 +559,463 @@ def apply_mask(wipf, mask):
     for baseobj, maskobj in zip(wipf_objs, mask_objs):
         baseobj.putalpha(maskobj.convert('L'))
 
-if __name__ == '__main__':
-    p, args = parse_args()
-    if args.output is None:
-        # Info dump only
-        with open(args.wipf, 'rb') as wipf:
-            load_wipf(wipf, args.wipf, True)
+def _encode_object(image, depth):
+    # Inverse of _decode_object_*: returns the uncompressed buffer and the RGBX palette (8-bit only)
+    if depth == 24:
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        return b''.join(channel.tobytes() for channel in reversed(image.split())), None
+    elif depth == 8:
+        if image.mode == 'L':
+            rgb_palette = bytes(b for i in range(256) for b in (i, i, i))
+        else:
+            if image.mode != 'P':
+                image = image.convert('RGB').quantize(256)
+            rgb_palette = bytes(image.getpalette('RGB')).ljust(256 * 3, b'\x00')
+        palette = bytearray(256 * 4)
+        for i in range(3):
+            palette[i::4] = rgb_palette[i::3]
+        return image.tobytes(), bytes(palette)
+    raise ValueError(f'Cannot encode images with bit-depth {depth}')
+
+def _compress_object(raw, max_chain=LZSS_MAX_CHAIN, verify=True):
+    compressed = wip_lzss_compress(raw, max_chain)
+    # Round-trip through the decoder so broken files never reach the game
+    if verify and wip_lzss_decompress(compressed, len(raw)) != raw:
+        raise RuntimeError('LZSS round-trip verification failed.')
+    return compressed
+
+def mask_from_alpha(image):
+    # Alpha channel as a grayscale image, suitable for writing as MSK
+    if image.mode == 'P':
+        image = image.convert('RGBA')
+    if image.mode not in ('RGBA', 'LA'):
+        return Image.new('L', image.size, 255)
+    return image.getchannel('A')
+
+def write_wipf(wipf, objects, depth, positions=None, layers=None, executor=None, max_chain=LZSS_MAX_CHAIN, verify=True):
+    # Objects are compressed through executor.map() when given
+    raws, palettes = zip(*(_encode_object(obj, depth) for obj in objects)) if len(objects) != 0 else ((), ())
+    if executor is not None:
+        compressed = list(executor.map(_compress_object, raws, itertools.repeat(max_chain, len(raws)), itertools.repeat(verify, len(raws))))
     else:
-        prefix, basename = os.path.split(args.wipf)
-        basename_nosuffix = '.'.join(basename.split('.')[:-1])
-        basename_suffix = basename.split('.')[-1]
-        # Load the main image
-        with open(args.wipf, 'rb') as wipf:
-            image = load_wipf(wipf, args.wipf)
-
-        # Loading masks
-        if args.mask is not None and args.auto_mask:
-            raise RuntimeError('Auto mask cannot be enabled when a mask is manually specified.')
-        elif args.mask is not None:
-            with open(args.mask, 'rb') as wipf:
-                mask = load_wipf(wipf, args.mask)
-                apply_mask(image, mask)
-        elif args.auto_mask and basename_suffix.lower() != 'msk':
-            # Case-insensitive search
-            basename_match = _fnmatch_escape(basename_nosuffix)
-            basename_match = ''.join(f'[{c.upper()}{c.lower()}]' if c.isascii() and c.isalpha() else c for c in basename_match)
-            matches = fnmatch.filter(os.listdir(prefix if len(prefix) != 0 else '.'), f'{basename_match}.[Mm][Ss][Kk]')
-            if len(matches) == 1:
-                mask_path = os.path.join(prefix, matches[0])
-                print(f'Automatically selecting mask file: {mask_path}')
-                with open(mask_path, 'rb') as wipf:
-                    mask = load_wipf(wipf, mask_path)
-                    apply_mask(image, mask)
-            elif len(matches) > 1:
-                raise RuntimeError('Multiple matches found for masks.')
-
-        available_output_fields = tuple(f[1] for f in string.Formatter().parse(args.output))
+        compressed = [_compress_object(raw, max_chain, verify) for raw in raws]
+
+    header = WIPFHeader()
+    header.magic = WIPF_MAGIC
+    header.objects = len(objects)
+    header.depth = depth
+    object_headers = []
+    for index, obj in enumerate(objects):
+        objhdr = WIPFObjectHeader()
+        objhdr.dimension.x, objhdr.dimension.y = obj.size
+        if positions is not None:
+            objhdr.position.x, objhdr.position.y = positions[index]
+        if layers is not None:
+            objhdr.unk = layers[index]
+        objhdr.size = len(compressed[index])
+        object_headers.append(objhdr)
+
+    wipf.write(header)
+    for objhdr in object_headers:
+        wipf.write(objhdr)
+    for palette, data in zip(palettes, compressed):
+        if palette is not None:
+            wipf.write(palette)
+        wipf.write(data)
+    return header, object_headers
+
+@functools.lru_cache(maxsize=None)
+def directory_index(path):
+    # Upper-cased stem -> upper-cased suffix -> matching paths, in listing order
+    index = {}
+    for f in listdir(path):
+        stem, dot, suffix = f.rpartition('.')
+        if len(dot) == 0:
+            continue
+        index.setdefault(stem.upper(), {}).setdefault(suffix.upper(), []).append(os.path.join(path, f))
+    return index
+
+def _composite_numpy(canvas, obj, x, y):
+    src = numpy.asarray(obj.convert('RGBA') if obj.mode not in ('RGB', 'RGBA') else obj)
+    height, width = src.shape[:2]
+    dst = canvas[y:y+height, x:x+width]
+    if src.shape[2] == 3:
+        dst[..., :3] = src
+        dst[..., 3] = 255
+        return
+    # Straight alpha "over" operator
+    src_a = src[..., 3:4].astype(numpy.float32) / 255
+    dst_a = dst[..., 3:4].astype(numpy.float32) / 255
+    out_a = src_a + dst_a * (1 - src_a)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        out_rgb = (src[..., :3] * src_a + dst[..., :3] * dst_a * (1 - src_a)) / out_a
+    dst[..., :3] = numpy.where(out_a > 0, numpy.rint(out_rgb), 0).astype(numpy.uint8)
+    dst[..., 3:4] = numpy.rint(out_a * 255).astype(numpy.uint8)
+
+def flatten(image):
+    object_headers = image['object_headers']
+    left = min(objhdr.position.x for objhdr in object_headers)
+    top = min(objhdr.position.y for objhdr in object_headers)
+    right = max(objhdr.position.x + objhdr.dimension.x for objhdr in object_headers)
+    bottom = max(objhdr.position.y + objhdr.dimension.y for objhdr in object_headers)
+    # Draw lower "layers" first (assuming that's what the unknown field is)
+    order = sorted(range(len(object_headers)), key=lambda i: object_headers[i].unk)
+    if numpy is not None:
+        canvas = numpy.zeros((bottom - top, right - left, 4), numpy.uint8)
+        for i in order:
+            objhdr = object_headers[i]
+            _composite_numpy(canvas, image['objects'][i], objhdr.position.x - left, objhdr.position.y - top)
+        canvas = Image.fromarray(canvas)
+    else:
+        canvas = Image.new('RGBA', (right - left, bottom - top))
+        for i in order:
+            objhdr = object_headers[i]
+            canvas.alpha_composite(image['objects'][i].convert('RGBA'), (objhdr.position.x - left, objhdr.position.y - top))
+    objhdr = WIPFObjectHeader()
+    objhdr.dimension.x, objhdr.dimension.y = right - left, bottom - top
+    objhdr.position.x, objhdr.position.y = left, top
+    return {'header': image['header'], 'object_headers': [objhdr], 'objects': [canvas]}
+
+def find_mask(path):
+    # Case-insensitive search
+    prefix, basename = os.path.split(path)
+    basename_nosuffix = '.'.join(basename.split('.')[:-1])
+    matches = directory_index(prefix).get(basename_nosuffix.upper(), {}).get('MSK', ())
+    if len(matches) > 1:
+        raise RuntimeError('Multiple matches found for masks.')
+    return matches[0] if len(matches) == 1 else None
+
+def renpy_image_id(image_id, index, renpy_image_tag=None):
+    image_tag = f'{renpy_image_tag} ' if renpy_image_tag else ''
+    return f'{image_tag}{image_id}' if index == 0 else f'{image_tag}{image_id} {index}'
+
+def pixel_hash(image):
+    # Exact identity of the decoded image (mode, size and pixels), independent of how it was stored
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f'{image.mode} {image.width}x{image.height}\n'.encode('ascii'))
+    h.update(image.tobytes())
+    return h.hexdigest()
+
+def renpy_image_metadata(image_object_id, output_path_renpy, position):
+    return _renpy_displayable_metadata(image_object_id, repr(output_path_renpy), position)
+
+def renpy_composite_metadata(image_object_id, size, layers, position):
+    # layers are ((x, y), output_path_renpy) pairs, drawn in order
+    width, height = size
+    children = ', '.join(f'({x}, {y}), {repr(output_path_renpy)}' for (x, y), output_path_renpy in layers)
+    return _renpy_displayable_metadata(image_object_id, f'Composite(({width}, {height}), {children})', position)
+
+def _renpy_displayable_metadata(image_object_id, displayable, position):
+    x, y = position
+    if (x, y) == (0, 0):
+        return [f'image {image_object_id} = {displayable}']
+    lines = [f'image {image_object_id}:', f'  {displayable}']
+    if x != 0 and y != 0:
+        lines.append(f'  offset ({x}, {y})')
+    else:
+        if x != 0:
+            lines.append(f'  xoffset {x}')
+        if y != 0:
+            lines.append(f'  yoffset {y}')
+    return lines
+
+class SavePipeline:
+    # Encodes images on a small thread pool (PIL releases the GIL while encoding) so decoding can go on meanwhile.
+    # submit() blocks while max_pending images are queued or being encoded, which caps memory use.
+    def __init__(self, threads=2, max_pending=None):
+        self.executor = futures.ThreadPoolExecutor(max_workers=threads)
+        self.slots = threading.BoundedSemaphore(max_pending if max_pending is not None else threads * 2)
+
+    def submit(self, fn, *args):
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(fn, *args)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        return future
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+
+def _save_object(obj, output_filename, webp, path):
+    # Throughput is counted in pixel bytes encoded
+    with profiling.stage('save', path, obj.width * obj.height * len(obj.getbands())):
+        if webp:
+            obj.save(output_filename, 'WebP', lossless=True)
+        else:
+            obj.save(output_filename, 'PNG')
+
+def wait_saves(result):
+    # Wait for the outputs of a convert_file(..., pipeline=...) result to be written. Re-raises encoder errors.
+    pending = result.pop('pending', ())
+    futures.wait(pending)
+    for future in pending:
+        future.result()
+    return result
+
+def convert_file(path, output, mask=None, auto_mask=False, webp=False, export_renpy=False, renpy_image_tag=None, renpy_image_prefix=None, flatten_objects=False, verbose=True, pipeline=None, hash_pixels=False):
+    # With a pipeline, saving is only queued and the caller needs to wait_saves() on the result
+    prefix, basename = os.path.split(path)
+    basename_nosuffix = '.'.join(basename.split('.')[:-1])
+    basename_suffix = basename.split('.')[-1]
+    # Loading masks
+    mask_path = None
+    if mask is not None and auto_mask:
+        raise RuntimeError('Auto mask cannot be enabled when a mask is manually specified.')
+    elif mask is not None:
+        mask_path = mask
+    elif auto_mask and basename_suffix.lower() != 'msk':
+        mask_path = find_mask(path)
+        if mask_path is not None and verbose:
+            print(f'Automatically selecting mask file: {mask_path}')
+    with contextlib.ExitStack() as stack:
+        # Objects are decoded (together with their mask objects) one at a time and released once queued for saving
+        mask_stream = None
+        if mask_path is not None:
+            mask_stream = stream_wipf(stack.enter_context(open_file(mask_path)), mask_path, raw=True, verbose=verbose)
+        header, object_headers, objects = stream_wipf(stack.enter_context(open_file(path)), path, mask=mask_stream, verbose=verbose)
+        if flatten_objects:
+            images = [wip_object['image'] for wip_object in objects]
+            with profiling.stage('flatten', path):
+                image = flatten({'header': header, 'object_headers': object_headers, 'objects': images})
+            del images
+            object_headers = image['object_headers']
+            objects = [{'index': 0, 'object_header': object_headers[0], 'image': image['objects'][0]}]
+            del image
+
+        available_output_fields = tuple(f[1] for f in string.Formatter().parse(output))
         has_offset = 'offset' in available_output_fields
         has_index = 'index' in available_output_fields
-        if len(image['objects']) > 1 and not has_index:
+        if len(object_headers) > 1 and not has_index:
             raise RuntimeError('Refusing to write multiple objects to the same output file.')
 
-        metadata_buf = []
+        result = {'source': path, 'mask': mask_path, 'objects': [], 'renpy': []}
+        if pipeline is not None:
+            result['pending'] = []
         image_id = basename_nosuffix.upper()
         # Decide the output filenames and dump the output files
-        for index, objpair in enumerate(zip(image['object_headers'], image['objects'])):
-            objhdr, obj = objpair
-            if (objhdr.position.x != 0 or objhdr.position.y != 0) and not has_offset and args.export_metadata_renpy is None:
+        for wip_object in objects:
+            index, objhdr, obj = wip_object['index'], wip_object['object_header'], wip_object['image']
+            del wip_object
+            if (objhdr.position.x != 0 or objhdr.position.y != 0) and not has_offset and not export_renpy:
                 warnings.warn(RuntimeWarning('{offset} not specified on output objects with offset. This information will be lost.'))
             output_fields = {}
             if has_index:
                 output_fields['index'] = index
             if has_offset:
                 output_fields['offset'] = f'{objhdr.position.x:d}x{objhdr.position.y:d}'
-            output_filename = args.output.format(**output_fields)
-            if args.webp:
-                obj.save(output_filename, 'WebP', lossless=True)
+            output_filename = output.format(**output_fields)
+            output_dir = os.path.dirname(output_filename)
+            if len(output_dir) != 0:
+                os.makedirs(output_dir, exist_ok=True)
+            if pipeline is not None:
+                result['pending'].append(pipeline.submit(_save_object, obj, output_filename, webp, path))
             else:
-                obj.save(output_filename, 'PNG')
-            if args.export_metadata_renpy is not None:
+                _save_object(obj, output_filename, webp, path)
+            object_result = {
+                'index': index,
+                'filename': output_filename,
+                'position': (objhdr.position.x, objhdr.position.y),
+                'dimension': (objhdr.dimension.x, objhdr.dimension.y),
+            }
+            if hash_pixels:
+                with profiling.stage('hash', path, obj.width * obj.height * len(obj.getbands())):
+                    object_result['pixel_hash'] = pixel_hash(obj)
+            del obj
+            if export_renpy:
                 _, output_basename = os.path.split(output_filename)
-                output_path_renpy = posixpath.join(args.renpy_image_prefix, output_basename) if args.renpy_image_prefix is not None else output_filename
-                image_tag = f'{args.renpy_image_tag} ' if args.renpy_image_tag else ''
-                image_object_id = f'{image_tag}{image_id}' if index == 0 else f'{image_tag}{image_id} {index}'
-                if (objhdr.position.x, objhdr.position.y) != (0, 0):
-                    metadata_buf.append(f'image {image_object_id}:')
-                    metadata_buf.append(f'  {repr(output_path_renpy)}')
-                    if objhdr.position.x != 0 and objhdr.position.y != 0:
-                        metadata_buf.append(f'  offset ({objhdr.position.x}, {objhdr.position.y})')
-                    else:
-                        if objhdr.position.x != 0:
-                            metadata_buf.append(f'  xoffset {objhdr.position.x}')
-                        if objhdr.position.y != 0:
-                            metadata_buf.append(f'  yoffset {objhdr.position.y}')
-                else:
-                    metadata_buf.append(f'image {image_object_id} = {repr(output_path_renpy)}')
+                output_path_renpy = posixpath.join(renpy_image_prefix, output_basename) if renpy_image_prefix is not None else output_filename
+                image_object_id = renpy_image_id(image_id, index, renpy_image_tag)
+                object_result['renpy_id'] = image_object_id
+                object_result['renpy_path'] = output_path_renpy
+                result['renpy'].extend(renpy_image_metadata(image_object_id, output_path_renpy, (objhdr.position.x, objhdr.position.y)))
+            result['objects'].append(object_result)
+    return result
+
+def archive_name(path):
+    # Name of the directory or ARC archive containing the file
+    prefix, _ = os.path.split(path)
+    archive = os.path.basename(os.path.abspath(prefix if len(prefix) != 0 else '.'))
+    if archive.lower().endswith('.arc'):
+        archive = archive[:-4]
+    return archive
+
+def _template_fields(path, fields=None):
+    basename = os.path.basename(path)
+    result = {
+        'name': '.'.join(basename.split('.')[:-1]),
+        'archive': archive_name(path),
+        # Per-object fields are filled in by convert_file()
+        'index': '{index}',
+        'offset': '{offset}',
+    }
+    if fields is not None:
+        result.update(fields)
+    return result
+
+def _error_result(path, e):
+    return {'source': path, 'error': f'{type(e).__name__}: {e}', 'objects': [], 'renpy': []}
+
+def _convert_task(path, output, options, pipeline=None):
+    try:
+        return convert_file(path, output, pipeline=pipeline, **options)
+    except Exception as e:
+        return _error_result(path, e)
+
+def _finish_task(result):
+    try:
+        return wait_saves(result)
+    except Exception as e:
+        return _error_result(result['source'], e)
+
+def _convert_pipelined(tasks, pipeline):
+    # Decode the next files while earlier ones are still being encoded. Results keep their order.
+    in_flight = collections.deque()
+    for task in tasks:
+        in_flight.append(_convert_task(*task, pipeline))
+        while len(in_flight) != 0 and all(future.done() for future in in_flight[0].get('pending', ())):
+            yield _finish_task(in_flight.popleft())
+    while len(in_flight) != 0:
+        yield _finish_task(in_flight.popleft())
+
+_worker_pipeline = None
+
+def _convert_chunk(tasks):
+    results = list(_convert_pipelined(tasks, _worker_pipeline))
+    # Profile records travel back to the parent with the results (see convert())
+    if profiling.enabled():
+        results[-1]['profile'] = profiling.drain()
+    return results
+
+def init_worker(profile=False, encode_threads=0):
+    global _worker_pipeline
+    if profile:
+        profiling.enable()
+        # Forked workers inherit the parent's records
+        profiling.drain()
+    if encode_threads > 0:
+        _worker_pipeline = SavePipeline(encode_threads)
+    # Load the decoder (and Numba's compiled code) once per worker process
+    with profiling.stage('worker_init'):
+        wip_lzss_decompress(b'\x00\x00\x00', 0)
+
+def convert(paths, output_template, jobs=None, mask=None, auto_mask=False, webp=False, export_renpy=False, renpy_image_tag=None, renpy_image_prefix=None, flatten_objects=False, verbose=False, encode_threads=2, hash_pixels=False, ordered=True, extra_tasks=()):
+    # encode_threads > 0 overlaps decoding with encoding (see SavePipeline)
+    # paths may contain (path, fields) pairs for extra template fields. {name} and {archive} are always available.
+    # Results carry their template fields, which identifies them when ordered=False yields them as they complete.
+    # extra_tasks are (function, argument, fields) work items run on the same workers before the conversions.
+    # function must be picklable and return a result dict, like convert_file.
+    tasks = []
+    task_fields = []
+    for path in paths:
+        fields = None
+        if not isinstance(path, str):
+            path, fields = path
+        fields = _template_fields(path, fields)
+        options = {
+            'mask': mask,
+            'auto_mask': auto_mask,
+            'webp': webp,
+            'export_renpy': export_renpy,
+            'renpy_image_tag': renpy_image_tag.format(**fields) if renpy_image_tag is not None else None,
+            'renpy_image_prefix': renpy_image_prefix.format(**fields) if renpy_image_prefix is not None else None,
+            'flatten_objects': flatten_objects,
+            'verbose': verbose,
+            'hash_pixels': hash_pixels,
+        }
+        tasks.append((path, output_template.format(**fields), options))
+        task_fields.append(fields)
+    if jobs == 1 or len(tasks) + len(extra_tasks) <= 1:
+        for fn, arg, fields in extra_tasks:
+            result = fn(arg)
+            profiling.merge(result.pop('profile', ()))
+            result['fields'] = fields
+            yield result
+        with SavePipeline(encode_threads) if encode_threads > 0 else contextlib.nullcontext() as pipeline:
+            for fields, result in zip(task_fields, _convert_pipelined(tasks, pipeline)):
+                result['fields'] = fields
+                yield result
+    else:
+        # Workers get a few files at a time so they can pipeline them too
+        chunk_size = max(1, min(8, len(tasks) // ((jobs or os.cpu_count() or 1) * 4)))
+        with futures.ProcessPoolExecutor(max_workers=jobs, initializer=init_worker, initargs=(profiling.enabled(), encode_threads)) as exe:
+            extra = {exe.submit(fn, arg): fields for fn, arg, fields in extra_tasks}
+            pending = dict(extra)
+            pending.update({exe.submit(_convert_chunk, tasks[i:i+chunk_size]): task_fields[i:i+chunk_size] for i in range(0, len(tasks), chunk_size)})
+            for future in pending if ordered else futures.as_completed(pending):
+                if future in extra:
+                    result = future.result()
+                    profiling.merge(result.pop('profile', ()))
+                    result['fields'] = extra[future]
+                    yield result
+                    continue
+                for fields, result in zip(pending[future], future.result()):
+                    profiling.merge(result.pop('profile', ()))
+                    result['fields'] = fields
+                    yield result
+
+def expand_inputs(inputs):
+    for input_path in inputs:
+        if os.path.isdir(input_path) or (input_path.lower().endswith('.arc') and os.path.isfile(input_path)):
+            for f in sorted(listdir(input_path)):
+                if f.lower().endswith('.wip'):
+                    yield os.path.join(input_path, f)
+        elif glob.has_magic(input_path):
+            yield from sorted(glob.glob(input_path))
+        else:
+            yield input_path
+
+if __name__ == '__main__':
+    p, args = parse_args()
+    if args.profile is not None:
+        profiling.enable()
+    failed = 0
+    if args.output is None:
+        # Info dump only
+        for path in expand_inputs(args.wipf) if args.batch else args.wipf:
+            with open_file(path) as wipf:
+                load_wipf(wipf, path, True)
+    elif args.batch:
+        metadata_buf = []
+        results = convert(
+            expand_inputs(args.wipf), args.output, args.jobs, args.mask, args.auto_mask, args.webp,
+            args.export_metadata_renpy is not None, args.renpy_image_tag, args.renpy_image_prefix, args.flatten,
+            encode_threads=args.encode_threads,
+        )
+        for result in results:
+            if 'error' in result:
+                failed += 1
+                print(f'{result["source"]}: {result["error"]}')
+            else:
+                print(f'{result["source"]}: {len(result["objects"])} object(s)')
+                metadata_buf.extend(result['renpy'])
         if args.export_metadata_renpy is not None:
             with open(args.export_metadata_renpy, 'w') as f:
                 for line in metadata_buf:
                     f.write(line)
                     f.write('\n')
+    else:
+        with SavePipeline(args.encode_threads) if args.encode_threads > 0 else contextlib.nullcontext() as pipeline:
+            result = wait_saves(convert_file(
+                args.wipf[0], args.output, args.mask, args.auto_mask, args.webp,
+                args.export_metadata_renpy is not None, args.renpy_image_tag, args.renpy_image_prefix, args.flatten,
+                pipeline=pipeline,
+            ))
+        if args.export_metadata_renpy is not None:
+            with open(args.export_metadata_renpy, 'w') as f:
+                for line in result['renpy']:
+                    f.write(line)
+                    f.write('\n')
+    if args.profile is not None:
+        profiling.write_report(args.profile)
+    if failed != 0:
+        sys.exit(1)
@@ -1,21 +1,117 @@
 #!/usr/bin/env python
 
-import sys
-
-if len(sys.argv) < 3:
-	print('Usage: wsc2scr <Input File> <Output File> [-r]')
-	sys.exit(1)
-
-if len(sys.argv) > 3 and sys.argv[3] == '-r':
-    reverse = True
-else:
-    reverse = False
-
-with open(sys.argv[1], 'rb') as fin, open(sys.argv[2], 'wb') as fout:
-    tmp = bytearray(1)
-    while fin.readinto(tmp) == len(tmp):
-        if reverse:
-            tmp[0] = ((tmp[0] << 2) | (tmp[0] >> 6)) & 0xff
+import argparse
+import os
+
+from concurrent import futures
+
+import will_arc
+
+# Each byte of a WSC file is rotated right by 2 bits (left by 2 when re-obfuscating)
+DEOBFUSCATE_TABLE = bytes(((b >> 2) | (b << 6)) & 0xff for b in range(256))
+OBFUSCATE_TABLE = bytes(((b << 2) | (b >> 6)) & 0xff for b in range(256))
+CHUNK_SIZE = 1024 * 1024
+
+
+def deobfuscate(data, reverse=False):
+    return bytes(data).translate(OBFUSCATE_TABLE if reverse else DEOBFUSCATE_TABLE)
+
+def convert_file(input_path, output_path, reverse=False):
+    table = OBFUSCATE_TABLE if reverse else DEOBFUSCATE_TABLE
+    with open(input_path, 'rb') as fin, open(output_path, 'wb') as fout:
+        for chunk in iter(lambda: fin.read(CHUNK_SIZE), b''):
+            fout.write(chunk.translate(table))
+
+def output_filename(input_path, reverse=False):
+    stem, _, _ = os.path.basename(input_path).rpartition('.')
+    return f'{stem}.{"WSC" if reverse else "SCR"}'
+
+def expand_inputs(inputs, reverse=False):
+    suffix = '.scr' if reverse else '.wsc'
+    for input_path in inputs:
+        if os.path.isdir(input_path):
+            for f in sorted(os.listdir(input_path)):
+                if f.lower().endswith(suffix):
+                    yield os.path.join(input_path, f)
         else:
-            tmp[0] = ((tmp[0] >> 2) | (tmp[0] << 6)) & 0xff
-        fout.write(tmp)
+            yield input_path
+
+def convert_files(inputs, output_dir, reverse=False, jobs=None):
+    os.makedirs(output_dir, exist_ok=True)
+    tasks = [(f, os.path.join(output_dir, output_filename(f, reverse))) for f in expand_inputs(inputs, reverse)]
+    with futures.ThreadPoolExecutor(max_workers=jobs) as exe:
+        for _ in exe.map(lambda t: convert_file(*t, reverse), tasks):
+            pass
+    return len(tasks)
+
+def extract_archive(arc_path, output_dir, version=None, jobs=None):
+    # Deobfuscate WSC objects straight out of the archive
+    os.makedirs(output_dir, exist_ok=True)
+    with will_arc.ArcArchive(arc_path, version) as arc:
+        def _extract(key):
+            _, name = key
+            payload = arc[key]
+            try:
+                with open(os.path.join(output_dir, f'{name}.SCR'), 'wb') as fout:
+                    for offset in range(0, len(payload), CHUNK_SIZE):
+                        fout.write(deobfuscate(payload[offset:offset+CHUNK_SIZE]))
+            finally:
+                payload.release()
+        keys = [key for key in arc if key[0] == 'WSC']
+        with futures.ThreadPoolExecutor(max_workers=jobs) as exe:
+            for _ in exe.map(_extract, keys):
+                pass
+    return len(keys)
+
+def pack_archive(inputs, arc_path, version=1):
+    # Obfuscate SCR files while writing them into a new archive
+    filename_cache = {}
+    for f in expand_inputs(inputs, True):
+        filename_cache[will_arc.object_key(output_filename(f, True), version)] = (f, os.path.getsize(f))
+    metadata, layout = will_arc.build_metadata(filename_cache, version)
+    with open(arc_path, 'wb') as arc:
+        will_arc.write_metadata(arc, metadata)
+        for fn, _ in layout:
+            with open(fn, 'rb') as fin:
+                for chunk in iter(lambda: fin.read(CHUNK_SIZE), b''):
+                    arc.write(chunk.translate(OBFUSCATE_TABLE))
+    return len(layout)
+
+def parse_args():
+    p = argparse.ArgumentParser(usage=(
+        '%(prog)s <Input File> <Output File> [-r]\n'
+        '       %(prog)s -d <Output Directory> <Input File/Directory>... [-r]\n'
+        '       %(prog)s -a <Archive> -d <Output Directory>\n'
+        '       %(prog)s -a <Archive> -r <Input File/Directory>...'
+    ))
+    p.add_argument('paths', nargs='*', help='Input and output file, or inputs (files or directories) when using -d or -a -r.')
+    p.add_argument('-r', '--reverse', action='store_true', help='Re-obfuscate SCR back to WSC.')
+    p.add_argument('-d', '--output-dir', help='Convert all inputs into this directory (WSC <-> SCR suffix is swapped).')
+    p.add_argument('-a', '--archive', help='Extract WSC objects from this ARC archive as SCR (requires -d), or pack SCR inputs into it with -r.')
+    p.add_argument('-v', '--version', type=int, help='ARC version (default to auto-detect, or 1 when packing).')
+    p.add_argument('-j', '--jobs', type=int, default=(os.cpu_count() or 1), help='Number of parallel workers when using -d (Defaults to # of CPUs or 1 if cannot be determined).')
+    args = p.parse_args()
+    if args.archive is not None:
+        if args.reverse and len(args.paths) == 0:
+            p.error('No input specified.')
+        elif not args.reverse and (args.output_dir is None or len(args.paths) != 0):
+            p.error('Extracting from an archive requires -d and no other paths.')
+    elif args.output_dir is None and len(args.paths) != 2:
+        p.error('Expecting exactly one input and one output file without -d.')
+    elif len(args.paths) == 0:
+        p.error('No input specified.')
+    return p, args
+
+if __name__ == '__main__':
+    p, args = parse_args()
+    if args.archive is not None and args.reverse:
+        count = pack_archive(args.paths, args.archive, args.version or 1)
+        print(f'Packed {count} file(s).')
+    elif args.archive is not None:
+        count = extract_archive(args.archive, args.output_dir, args.version, args.jobs)
+        print(f'Extracted {count} file(s).')
+    elif args.output_dir is not None:
+        count = convert_files(args.paths, args.output_dir, args.reverse, args.jobs)
+        print(f'Converted {count} file(s).')
+    else:
+        convert_file(args.paths[0], args.paths[1], args.reverse)